@@ -0,0 +1,193 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from nidaqmx.constants import AcquisitionType
+
+RAW_SECONDS = 5.0 # full rate history kept for burst windows
+RETRY_DELAY = 1.0 # s to wait after a failed read before restarting the task
+
+class ring_buffer:
+    ###
+    # ring_buffer(capacity, channels) - preallocated numpy ring of timestamped samples
+    # capacity - samples kept per channel, older samples are overwritten
+    # channels - number of channels per sample
+    # one writer (the acquisition thread) and any number of readers, readers get copies
+    ###
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.data = np.zeros((capacity, channels))
+        self.count = 0 # samples written since the start, the newest sample is at (count - 1) % capacity
+        self.lock = threading.Lock()
+
+    def write(self, times, block):
+        # times - n timestamps, block - n x channels samples
+        n = len(times)
+        if n > self.capacity: # only the newest capacity samples fit
+            times, block, n = times[-self.capacity:], block[-self.capacity:], self.capacity
+        with self.lock:
+            start = self.count % self.capacity
+            first = min(n, self.capacity - start)
+            self.times[start:start + first] = times[:first]
+            self.data[start:start + first] = block[:first]
+            self.times[:n - first] = times[first:]
+            self.data[:n - first] = block[first:]
+            self.count += n
+
+    def latest(self):
+        # (time, samples) of the newest sample, None before the first one
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.count - 1) % self.capacity
+            return self.times[i], self.data[i].copy()
+
+    def last(self, n):
+        # (times, samples) of the newest n samples, oldest first
+        with self.lock:
+            n = min(n, self.count, self.capacity)
+            idx = np.arange(self.count - n, self.count) % self.capacity
+            return self.times[idx], self.data[idx]
+
+    def since(self, t):
+        # (times, samples) of every sample still held that is newer than t
+        with self.lock:
+            n = min(self.count, self.capacity)
+            idx = np.arange(self.count - n, self.count) % self.capacity
+            times = self.times[idx]
+            keep = idx[times > t]
+            return self.times[keep], self.data[keep]
+
+
+class acquisition_stream:
+    ###
+    # acquisition_stream(task, rate, block, capacity) - continuous, sample clocked acquisition of an AI task
+    # task - nidaqmx task with its channels added, (re)configured here for continuous sampling
+    # rate - sample rate per channel (Hz)
+    # block - samples per channel read from the DAQ at a time
+    # capacity - samples per channel kept in self.buffer
+    # decimate - self.buffer keeps the mean of every decimate samples, block must be a multiple of it
+    # burst_capacity - full rate samples kept in self.bursts, 0 for no burst capture
+    # a background thread drains the task block by block into self.buffer (a ring_buffer)
+    # timestamps come from the sample count and the DAQ sample clock, anchored at time.monotonic() when
+    # the task started, so they stay evenly spaced however late a block is read. Every stream keeps its
+    # own timestamps on that same monotonic clock, so streams at different rates line up afterwards
+    #
+    # Burst windows - trigger(t) asks for every full rate sample from t - pre to t + post, eg. around a
+    # valve opening. Outside the windows only the decimated samples are kept
+    # overlapping windows (eg. two valves opened together) are merged, and a sample is never copied into
+    # self.bursts twice, so the bursts stay in time order
+    # the last few seconds at full rate are held in self.raw so a window can reach back before its trigger
+    #
+    # A failed read (buffer overflow, device removed) restarts the task after RETRY_DELAY. The lost samples
+    # show up as one nan sample in every buffer, and the timestamps are anchored again at the restart
+    ###
+    def __init__(self, task, rate, block, capacity, decimate=1, burst_capacity=0):
+        if block % decimate:
+            raise ValueError(f"block {block} is not a multiple of decimate {decimate}")
+        self.task = task
+        self.rate = rate
+        self.block = block
+        self.decimate = decimate
+        self.channels = len(task.ai_channels.channel_names)
+        self.buffer = ring_buffer(capacity, self.channels)
+        self.raw = ring_buffer(max(int(rate*RAW_SECONDS), block), self.channels) if burst_capacity else None
+        self.bursts = ring_buffer(burst_capacity, self.channels) if burst_capacity else None
+        self.windows = [] # [start, end, tags] waiting for their samples, sorted and not overlapping
+        self.captured = deque(maxlen=1000) # (start, end, tags) of windows copied into self.bursts
+        self.burst_until = float("-inf") # timestamp of the newest sample in self.bursts
+        self.windows_lock = threading.Lock()
+        self.stopthread = threading.Event()
+        self.thread = None
+
+    def start(self):
+        task = self.task
+        task.stop()
+        task.timing.cfg_samp_clk_timing(self.rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                        samps_per_chan=max(self.block*10, int(self.rate*10)))
+        self.thread = threading.Thread(target=self.acquire, args=(self.stopthread,))
+        task.start()
+        self.t0 = time.monotonic()
+        self.samples = 0
+        self.thread.start()
+
+    def trigger(self, t, pre=0.05, post=0.5, tag=None):
+        # t - time.monotonic() of the event, pre/post - seconds of full rate data either side
+        if self.bursts is None:
+            return
+        start, end, tags = t - pre, t + post, (tag,)
+        with self.windows_lock:
+            keep = []
+            for window in self.windows:
+                if window[1] < start or window[0] > end:
+                    keep.append(window)
+                else: # overlaps, fold it into the new window
+                    start, end, tags = min(start, window[0]), max(end, window[1]), window[2] + tags
+            keep.append([start, end, tags])
+            self.windows = sorted(keep)
+
+    def acquire(self, stopthread):
+        timeout = self.block/self.rate + 2.0
+        while not stopthread.is_set():
+            try:
+                data = self.task.read(number_of_samples_per_channel=self.block, timeout=timeout)
+            except Exception as e:
+                if stopthread.is_set():
+                    break
+                logging.error(f"{self.task.name} acquisition: {e}")
+                self.recover(stopthread)
+                continue
+            block = np.asarray(data, dtype=float).reshape(self.channels, -1).T # samples x channels
+            times = self.t0 + (self.samples + np.arange(len(block)))/self.rate
+            self.samples += len(block)
+            if self.raw is not None:
+                self.raw.write(times, block)
+                self.capture(times[-1])
+            if self.decimate > 1:
+                times = times.reshape(-1, self.decimate).mean(axis=1)
+                block = block.reshape(-1, self.decimate, self.channels).mean(axis=1)
+            self.buffer.write(times, block)
+
+    def recover(self, stopthread):
+        # restarts the task after a failed read, stays quiet for RETRY_DELAY so a dead device can't spin
+        if stopthread.wait(RETRY_DELAY):
+            return
+        try:
+            self.task.stop()
+            self.task.start()
+        except Exception as e:
+            logging.error(f"{self.task.name} acquisition restart: {e}")
+            return # the next read fails too and comes back here
+        gap = np.full((1, self.channels), np.nan)
+        t = np.array([self.t0 + self.samples/self.rate]) # where the next sample was due
+        for buffer in (self.raw, self.buffer):
+            if buffer is not None:
+                buffer.write(t, gap)
+        self.t0 = time.monotonic()
+        self.samples = 0
+        logging.info(f"{self.task.name} acquisition restarted, gap from {t[0]:.3f} to {self.t0:.3f}")
+
+    def capture(self, now):
+        # copies finished burst windows from the raw ring into self.bursts
+        with self.windows_lock:
+            done = [w for w in self.windows if w[1] <= now]
+            self.windows = [w for w in self.windows if w[1] > now]
+        for start, end, tags in done:
+            times, block = self.raw.since(max(start, self.burst_until))
+            keep = times <= end
+            if keep.any():
+                self.bursts.write(times[keep], block[keep])
+                self.burst_until = times[keep][-1]
+            self.captured.append((start, end, tags))
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def stop(self):
+        self.stopthread.set()
+        self.task.stop() # ends a pending read
+        if self.thread is not None:
+            self.thread.join()
@@ -1,47 +1,301 @@
-import pandas as pd
+import json
 import logging
+import os
 import time
 import threading
+from collections import namedtuple
+
+import recipe as recipes_module
+from recipe import HW_RATE, RecipeError, render_waveform, valve_events
+from scheduler import SPIN_TIME, deadline_scheduler
+from timing_log import timing_log
+
+# loop, loops - loop the run is on (0 based) and loops in the run
+# row, rows - recipe row the run is on (0 based) and rows per loop
+# elapsed - seconds since the run started, pauses included
+# remaining - planned seconds left from the start of the current row, pauses not included
+# state - "running", "paused", "finished", "aborted" or "failed"
+run_progress = namedtuple("run_progress", ["loop", "loops", "row", "rows", "elapsed", "remaining", "state"])
+
+class progress_channel:
+    ###
+    # progress_channel(clock, recipe, loops) - progress of a run, written by the run thread, read by anyone
+    # publish() builds a new run_progress and swaps it into self.latest, readers just read self.latest
+    # a single reference assignment, so there is no lock, the run never waits on a reader and a reader
+    # never sees half an update. Published once per recipe row (once per waveform block for hardware
+    # timed runs), so the cost is one small tuple per row
+    ###
+    def __init__(self, clock, recipe, loops):
+        self.clock = clock
+        self.starts = [step.start for step in recipe.steps]
+        self.cycle_time = recipe.cycle_time
+        self.loops = loops
+        self.start = clock()
+        self.latest = None
+
+    def publish(self, state, loop=None, row=None):
+        # loop, row - position of the run, None keeps the last one published
+        if loop is None:
+            loop, row = self.latest.loop, self.latest.row
+        offset = loop*self.cycle_time + (self.starts[row] if loop < self.loops else 0.0)
+        self.latest = run_progress(loop, self.loops, row, len(self.starts), self.clock() - self.start,
+                                   self.loops*self.cycle_time - offset, state)
 
 class ald_controller:
     ### 
-    # aldRun(file, loops, gvc) - executes an ALD Run
-    # file - recipe file read in to program
+    # aldRun(loops, vc) - executes an ALD Run
+    # self.file - recipe file read in to program, compiled once before any valve moves
     # loops - number of times to loop through the recipe
-    # vc - gas_valve_controller() object
+    # vc - valve_controller() object
+    # hardware_timed - render the recipe into a sample clocked DO waveform and let the DAQ play it,
+    #                  pulses are then accurate to the sample clock and not limited to > 40ms
+    # rate - DO sample clock rate for hardware timed runs (Hz)
+    # block - number of cycles rendered into each waveform for hardware timed runs
+    # spin - busy-wait this long before each step deadline, 0 to only sleep
+    # resume - pick up from self.checkpoint instead of loop 0 if it was left by a run of the same recipe
+    # software timed runs switch valves on absolute deadlines from the run start, valves pulsed in the same
+    # row open together and close at their own times. self.timing holds a timing_log of the planned and
+    # actual time of every valve actuation in the last software timed run, logged as a summary at the end
+    # clock - optional object with time() and sleep() (eg. simulation.virtual_clock) to run against
+    #         instead of the wall clock, None uses time.monotonic/time.sleep
+    # recipes - recipe_cache the run compiles through, defaults to the cache shared with the GUI
+    # checkpoint_file - optional json file the checkpoint is kept in, so a run can be resumed after a restart
+    #
+    # pause(), resume() and abort() can be called from any thread while a run is going
+    # pause closes all valves and holds the run at the current row, resume restarts that row from its
+    # beginning (a half-finished dose is dosed again, a purge runs its full time), abort closes all valves
+    # and ends the run. self.checkpoint holds the loop and row the run got to, None once a run completes
+    # self.ready - runs wait for this event before the first valve moves, cleared by temp_controller.preheat
+    #              until every zone is at setpoint. Set by default
+    #
+    # create_run_thread(loops, vc, ...) runs aldRun on its own thread, so the caller (the GUI) never blocks
+    # status() returns the run_progress of the current or last run, None before one has started
     ###
-    def create_run_thread(self,loops,vc):
-        self.aldRunThread = threading.Thread(target=self.aldrun, args=(self.file, loops, vc))
+    def __init__(self, clock=None, recipes=None, checkpoint_file=None):
+        self.file = None
+        self.clock = clock
+        self.recipes = recipes if recipes is not None else recipes_module.cache
+        self.timing = None
+        self.aldRunThread = None
+        self.progress = None # progress_channel of the current or last run
+
+        self.interrupt = threading.Event() # set by pause() and abort(), wakes the run out of its wait
+        self.resumed = threading.Event() # cleared while paused
+        self.resumed.set()
+        self.aborted = threading.Event()
+        self.ready = threading.Event()
+        self.ready.set()
+
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint = None # {"file", "stamp", "loops", "loop", "row"}
+        self.stamp = None # (mtime_ns, size) of the recipe file the current run compiled, see recipe_cache
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                self.checkpoint = json.load(f)
+
+    def create_run_thread(self, loops, vc, **kwargs):
+        # starts aldRun(loops, vc, **kwargs) on the run thread, returns False if a run is already going
+        if self.running():
+            logging.warning("Run already in progress")
+            return False
+        self.aldRunThread = threading.Thread(target=self.run_worker, args=(loops, vc), kwargs=kwargs, name="ALD run")
         self.aldRunThread.start()
+        return True
+
+    def run_worker(self, loops, vc, **kwargs):
+        try:
+            self.aldRun(loops, vc, **kwargs)
+        except Exception as e:
+            vc.close_all()
+            logging.error(f"Run Failed: {e}")
+            print(f"Run Failed: {e}")
+            if self.progress is not None and self.progress.latest is not None:
+                self.progress.publish("failed")
+
+    def status(self):
+        return self.progress.latest if self.progress is not None else None
+
+    def pause(self):
+        self.resumed.clear()
+        self.interrupt.set()
+        logging.info("Run Pausing")
+
+    def resume(self):
+        self.interrupt.clear()
+        self.resumed.set()
+        logging.info("Run Resuming")
+
+    def abort(self):
+        self.aborted.set()
+        self.interrupt.set()
+        self.resumed.set() # let a paused run see the abort
+        logging.info("Run Aborting")
+
+    def save_checkpoint(self, file, loops, loop, row, persist=True):
+        # persist - also write it to self.checkpoint_file
+        self.checkpoint = {"file": os.path.abspath(file), "stamp": self.stamp, "loops": loops, "loop": loop, "row": row}
+        if persist and self.checkpoint_file is not None:
+            with open(self.checkpoint_file, "w") as f:
+                json.dump(self.checkpoint, f)
+
+    def clear_checkpoint(self):
+        self.checkpoint = None
+        if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def start_point(self, loops, resume, recipe):
+        # loop and row index to start a run from
+        # raises RecipeError rather than resume in a recipe that was edited since the checkpoint
+        c = self.checkpoint
+        if resume and c is not None and c["file"] == os.path.abspath(self.file) and c["loops"] == loops:
+            if c.get("stamp") != self.stamp or c["row"] >= len(recipe.steps):
+                raise RecipeError(f"{recipe.file}: changed since the checkpoint at loop {c['loop']}, row {c['row']}, not resuming")
+            logging.info(f"Resuming run at loop {c['loop']}, row {c['row']}")
+            return c["loop"], c["row"]
+        return 0, 0
+
+    def running(self):
+        return self.aldRunThread is not None and self.aldRunThread.is_alive()
+
+    def resumable(self, loops):
+        # True if a run of self.file with loops loops would resume from self.checkpoint
+        c = self.checkpoint
+        if c is None or self.file is None or c["file"] != os.path.abspath(self.file) or c["loops"] != loops:
+            return False
+        try:
+            return c.get("stamp") == self.recipe_stamp(self.file)
+        except OSError: # recipe moved or deleted
+            return False
+
+    def recipe_stamp(self, file):
+        # (mtime_ns, size) of file as a list, json keeps it the same way
+        return list(self.recipes.entry(file)[0])
+
+    def wait_ready(self):
+        # waits for the heaters to be ready, returns False if the run was aborted first
+        if not self.ready.is_set():
+            logging.info("Run waiting for heaters to reach setpoint")
+        while not self.ready.wait(0.5):
+            if self.aborted.is_set():
+                return False
+        return not self.aborted.is_set()
+
+    def hold(self, vc):
+        # called when a wait was interrupted, returns True if the run should carry on
+        vc.close_all()
+        if not self.aborted.is_set():
+            logging.info("Run Paused, all valves closed")
+            if self.progress is not None:
+                self.progress.publish("paused")
+            self.resumed.wait()
+        if self.aborted.is_set():
+            vc.close_all()
+            if self.progress is not None:
+                self.progress.publish("aborted")
+            logging.info(f"Run Aborted at loop {self.checkpoint['loop']}, row {self.checkpoint['row']}")
+            return False
+        return True
+
+    def aldRun(self,loops, vc, hardware_timed=False, rate=HW_RATE, block=1, spin=SPIN_TIME, resume=False):
+        self.aborted.clear()
+        self.interrupt.clear()
+        self.resumed.set()
+        self.progress = None
+        if not self.wait_ready():
+            return
+        if hardware_timed:
+            return self.aldRun_hardware_timed(loops, vc, rate, block, resume)
+        self.stamp = self.recipe_stamp(self.file)
+        recipe = self.recipes.compile(self.file) # raises RecipeError before any valve moves
+        # events and end time of each row, the rows are the checkpoint and resume points
+        events = valve_events(recipe)
+        rows = [([(e.time, dict(e.states)) for e in events if e.row == step.row], step.start + step.duration) for step in recipe.steps]
+        logging.info(f"Run Starting: {recipe.file}, {loops} loops, {len(recipe.steps)} steps, {recipe.cycle_time}s per loop")
+        print("Run Starting")
+        first_loop, first_row = self.start_point(loops, resume, recipe)
+        if self.clock is None:
+            scheduler = deadline_scheduler(spin=spin, interrupt=self.interrupt)
+        else: # a virtual clock only moves when slept on, nothing to spin for
+            scheduler = deadline_scheduler(spin=0, clock=self.clock.time, sleep=self.clock.sleep, interrupt=self.interrupt)
+        first_offset = first_loop*recipe.cycle_time + recipe.steps[first_row].start
+        scheduler.start(first_offset)
+        self.timing = timing_log(loops*sum(len(e.states) for e in events), scheduler.clock)
+        self.timing.start(scheduler.start_time)
+        vc.timing = self.timing # the valve controller marks the actual time of each write
+        self.progress = progress_channel(scheduler.clock, recipe, loops)
+        for i in range(first_loop, loops): # number of ALD cycles
+            cycle_start = i*recipe.cycle_time
+            for j in range(first_row if i == first_loop else 0, len(recipe.steps)):
+                self.save_checkpoint(recipe.file, loops, i, j, persist=(j == 0)) # on disk once a loop
+                self.progress.publish("running", i, j)
+                while not self.run_row(scheduler, vc, cycle_start, rows[j], i, recipe.steps[j].row):
+                    self.save_checkpoint(recipe.file, loops, i, j)
+                    if not self.hold(vc):
+                        vc.timing = None
+                        return
+                    scheduler.rebase(cycle_start + recipe.steps[j].start) # restart the row from now
+                    self.timing.start(scheduler.start_time)
+                    self.progress.publish("running")
+        vc.close_all() # make sure all valves are shut off at the end of a run
+        vc.timing = None
+        self.clear_checkpoint()
+        self.progress.publish("finished", loops, 0)
+        # scheduler.elapsed() is the timeline position, rebased on every resume, the progress channel has the wall time
+        wall = scheduler.clock() - self.progress.start
+        logging.info(f"Run Finished in {wall:.3f}s including pauses ({loops*recipe.cycle_time - first_offset:.3f}s planned)")
+        self.log_timing()
+
+    def log_timing(self):
+        summary = self.timing.summary()
+        ms = ", ".join(f"{key} {value*1000:.3f}ms" for key, value in summary.items() if key not in ("actuations", "dropped"))
+        logging.info(f"Run Timing: {summary['actuations']} actuations ({summary['dropped']} dropped), {ms}")
+        return summary
+
+    def run_row(self, scheduler, vc, cycle_start, row_events, loop, row):
+        # switches the valves for one recipe row and waits out its Delay
+        # returns False if a pause or abort cut in
+        events, end = row_events
+        for t, states in events: # valve index matches vc.tasks, AV01 is line 0, AV02 is line 1, etc.
+            if scheduler.wait_until(cycle_start + t) is None:
+                return False
+            vc.set_valves(states, planned=(cycle_start + t, loop, row))
+        return scheduler.wait_until(cycle_start + end) is not None
 
-    def aldRun(self,loops, vc):
-        data = pd.read_csv(self.file)
-        dataNP = data.to_numpy()
-        print(vc.tasks)
-        print(dataNP)
-        # log run starting and recipe order
+    def aldRun_hardware_timed(self, loops, vc, rate=HW_RATE, block=1, resume=False):
+        # the whole run plays on one sample clocked task, streamed block by block, so there is no gap between
+        # blocks and only the last one ends on the closing sample. Pause and abort stop the waveform part way,
+        # the checkpoint and resume point is the start of the block that was playing
+        self.stamp = self.recipe_stamp(self.file)
+        recipe = self.recipes.compile(self.file, threshold=0.0) # no 40ms floor, the sample clock times the pulses
+        block = max(1, min(block, loops))
+        body = render_waveform(recipe, rate, block, tail=False) # raises RecipeError for pulses shorter than a sample
+        logging.info(f"Hardware Timed Run Starting: {recipe.file}, {loops} loops at {rate}Hz, {block} loops per block")
         print("Run Starting")
-        for i in range(loops): #This is the number of loops the user wants to iterate the current file (ie - number of ALD cycles)
-            for j in range(0,len(dataNP),1):#For each row in the .csv file, we want to set the experimental parameters accordingly
-                if j >> 0: #Sending the current line and previous line for comparison in setVar
-                    for k in range(len(dataNP[j])-1): #Ignore the sleep column for this, but iterate through the rest of the line.
-                        if int(dataNP[j][k]) == -1: #If the cell has value -1, ignore it
-                            pass
-                        elif dataNP[j][k] > 0.04: #Any cell that is over 0.04s we do a pulsevalve. Note that means a 40ms pulse is the fastest.
-                            vc.pulseValve(vc.tasks[k],dataNP[j][6]) #pulse DOx where x is the DO line. This works with the k variable because AV01 is line 0, AV02 is line 1, etc.
-                        else: 
-                            pass #For most of the 2s sleeps, this is where I'll be.
-                    logging.info('going to sleep for {} seconds'.format(dataNP[j][6]))
-                    time.sleep(dataNP[j][6]) #I had to move the sleep for the ALD pulses into the pulseValve, so we have a redundant sleep here on recipe lines where the ald valves cycle. But, this one happens after the ald valve opens and closes, so it shouldn't be a big deal.
-                elif j == 0: #sending the first line and the first line changed by a bit to ensure all values are set. This condition will be triggered once per loop, when we go to the first row in the recipe file.
-                    for k in range(len(dataNP[j])-1):
-                        if int(dataNP[j][k]) == -1: #If the cell has value -1, ignore it
-                            pass
-                        else:
-                            vc.pulse_valve(vc.tasks[k],dataNP[j][6]) #test
+        done, _ = self.start_point(loops, resume, recipe)
+        self.progress = progress_channel(self.clock.time if self.clock is not None else time.monotonic, recipe, loops)
+        while done < loops:
+            full = (loops - done - 1)//block # blocks before the last one, which carries the closing sample
+            blocks = [body]*full + [render_waveform(recipe, rate, loops - done - full*block)]
+            start = done
+            def played(n):
+                # a block finished, the next one is the checkpoint
+                if n < len(blocks):
+                    self.save_checkpoint(recipe.file, loops, start + n*block, 0)
+                    self.progress.publish("running", start + n*block, 0)
+            played(0)
+            n = vc.play_waveform_blocks(blocks, rate, stop=self.interrupt, progress=played)
+            if n == len(blocks):
+                break
+            done = start + n*block
+            if not self.hold(vc):
+                return
+            # resume from the start of the block that was cut short
         vc.close_all() # make sure all valves are shut off at the end of a run
+        self.clear_checkpoint()
+        self.progress.publish("finished", loops, 0)
 
     def close(self):
-        if 'self.aldRunThread' in locals():
+        if self.running():
+            self.abort()
             self.aldRunThread.join()
-        print("ALD Recipe Controller Closing")
\ No newline at end of file
+        print("ALD Recipe Controller Closing")
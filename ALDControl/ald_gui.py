@@ -1,11 +1,8 @@
 import tkinter as tk
 from tkinter import filedialog
-import csv
 from matplotlib.figure import Figure
-import matplotlib.animation as animation
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 import matplotlib.pyplot as plt
-from collections import deque
 
 import nidaqmx
 from nidaqmx.constants import (
@@ -24,6 +21,10 @@ from valve_controller import valve_controller
 from temp_controller import temp_controller
 from pressure_controller import pressure_controller
 from ald_controller import ald_controller
+from do_port import do_port
+from io_worker import io_worker
+from live_plot import live_plot, PLOT_INTERVAL
+from telemetry_store import telemetry_store
 
 # Constants
 BG_COLOR = "grey95"
@@ -39,7 +40,10 @@ FONT = ("Helvetica", 16)
 Y_MIN_DEFAULT = 0.4
 Y_MAX_DEFAULT = 0.8
 
-MAIN_POWER_CHANNEL = "CDAQ1Mod4/line11"
+MAIN_POWER_LINE = "Main Power" # CDAQ1Mod4/line11, see do_port.PORT_CHANNELS
+LOG_INTERVAL = 0.5 # s between logged temperature/pressure readings
+RUN_LOOPS = 100 # loops per recipe run
+CHECKPOINT_FILE = "ald_checkpoint.json" # where an aborted or interrupted run is picked up from
 
 class App(tk.Tk):
     def __init__(self):
@@ -49,10 +53,21 @@ class App(tk.Tk):
         self.configure(bg=BG_COLOR)
 
         # Initialize valve_controller
-        self.valve_controller = valve_controller()
-        self.temp_controller = temp_controller()
+        # valves, heaters and main power all share one task on CDAQ1Mod4
+        self.do_port = do_port()
+        self.valve_controller = valve_controller(self.do_port)
+        self.temp_controller = temp_controller(self.do_port)
         self.pressure_controller = pressure_controller()
-        self.ald_controller=ald_controller()
+        # sample clocked acquisition into ring buffers, every read_* below comes from the buffers
+        self.temp_controller.start_acquisition()
+        self.pressure_controller.start_acquisition()
+        self.valve_controller.listeners.append(self.pressure_controller.on_valve) # full rate pressure around every pulse
+        self.ald_controller=ald_controller(checkpoint_file=CHECKPOINT_FILE)
+        # hardware calls from buttons run on this worker, the Tk thread only draws and reads the buffers
+        self.io = io_worker()
+        self.stoplog = threading.Event()
+        self.logthread = threading.Thread(target=self.log_data, args=(self.stoplog,))
+        self.logthread.start()
 
 
         # Top pane with "Main Power" button
@@ -62,6 +77,7 @@ class App(tk.Tk):
         self.mptask = self.create_main_power()
         
         top_frame = tk.Frame(top_pane, bg=BG_COLOR, height=50, highlightbackground=BORDER_COLOR, highlightthickness=1)
+        self.main_power_on = False
         self.main_power_button = tk.Button(top_frame, text='Main Power OFF',fg=BUTTON_TEXT_COLOR, bg=OFF_COLOR, relief=BUTTON_STYLE, command=lambda:self.toggle_main_power(self.mptask))
         self.main_power_button.pack(pady=10)
         top_pane.add(top_frame)
@@ -91,10 +107,59 @@ class App(tk.Tk):
         self.create_file_controls()
 
         self.ald_panel = tk.Frame(bottom_pane, bg=TEXT_COLOR, highlightbackground=BORDER_COLOR,highlightthickness=1)
+        bottom_pane.add(self.ald_panel)
         self.create_ald_panel()
     
     def create_ald_panel(self):
-        tk.Button(self.ald_panel, text="Run Recipe",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda:self.ald_controller.aldRun(100,self.valve_controller)).pack(pady=5, anchor=tk.NW)
+        # the run goes on the controller's run thread, these buttons and the plot stay live during it
+        tk.Button(self.ald_panel, text="Run Recipe",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda:self.ald_controller.create_run_thread(RUN_LOOPS,self.valve_controller)).pack(pady=5, anchor=tk.NW)
+        row = tk.Frame(self.ald_panel, bg=TEXT_COLOR)
+        row.pack(anchor=tk.NW)
+        tk.Button(row, text="Pause",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=self.ald_controller.pause).pack(side=tk.LEFT, padx=5)
+        tk.Button(row, text="Resume",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=self.resume_run).pack(side=tk.LEFT, padx=5)
+        tk.Button(row, text="Abort",font=FONT, bg=OFF_COLOR, fg=BUTTON_TEXT_COLOR, relief=BUTTON_STYLE, command=self.ald_controller.abort).pack(side=tk.LEFT, padx=5)
+        self.run_status = None
+        self.run_status_time = None # time.monotonic() when run_status was first seen
+        self.run_text = ""
+        self.run_label = tk.Label(self.ald_panel, text="No run", bg=TEXT_COLOR, font=FONT, justify=tk.LEFT)
+        self.run_label.pack(pady=5, anchor=tk.NW)
+
+    def resume_run(self):
+        # resumes a paused run, or restarts an aborted or interrupted one from its checkpoint
+        if self.ald_controller.running():
+            self.ald_controller.resume()
+        elif self.ald_controller.resumable(RUN_LOOPS):
+            self.ald_controller.create_run_thread(RUN_LOOPS, self.valve_controller, resume=True)
+        else:
+            logging.info("No run to resume for the loaded recipe")
+            self.run_label.config(text="No run to resume")
+
+    def show_progress(self):
+        # reads the run's progress channel, never waits on the run thread
+        # the loop/row text changes once per row, elapsed and finish time are brought forward every tick
+        status = self.ald_controller.status()
+        if status is None:
+            return
+        now = time.monotonic()
+        if status is self.run_status and status.state not in ("running", "paused"):
+            return # nothing moving, leave the label (eg. a resume message) alone
+        if status is not self.run_status:
+            self.run_status, self.run_status_time = status, now
+            if status.state == "finished":
+                self.run_text = f"Finished {status.loops} loops"
+            else:
+                self.run_text = f"{status.state.capitalize()}: loop {status.loop+1}/{status.loops}, row {status.row+1}/{status.rows}"
+        since = now - self.run_status_time
+        if status.state == "running":
+            elapsed, remaining = status.elapsed + since, max(status.remaining - since, 0.0)
+        elif status.state == "paused": # the clock runs, the recipe doesn't
+            elapsed, remaining = status.elapsed + since, status.remaining
+        else:
+            elapsed, remaining = status.elapsed, None
+        text = f"{self.run_text}\nElapsed {time.strftime('%H:%M:%S', time.gmtime(elapsed))}"
+        if remaining is not None:
+            text += f", finish at {time.strftime('%H:%M:%S', time.localtime(time.time() + remaining))}"
+        self.run_label.config(text=text)
         
     def create_number_display_panel(self):
         frame = tk.Frame(bg=BG_COLOR, highlightbackground=BORDER_COLOR, highlightthickness=1)
@@ -136,9 +201,12 @@ class App(tk.Tk):
         frame.grid_rowconfigure(0, weight=1)
         frame.grid_columnconfigure(0, weight=1)
 
-        self.fig, self.ax, self.pressure, self.t_array, self.t_start, self.sensors = self.plotinitialize()
-        ani = animation.FuncAnimation(self.fig, self.animate, interval=500)
+        self.fig, self.ax, self.t_start, self.sensors = self.plotinitialize()
         tempplot = FigureCanvasTkAgg(self.fig, frame)
+        traces = self.sensors[-1:] + self.sensors[:-1] # pressure trace first
+        self.telemetry = telemetry_store(len(traces)) # every plotted sample, for zooming into the past
+        self.plot = live_plot(tempplot, self.ax, traces, store=self.telemetry)
+        self.t_last = self.t_start
         tempplot.draw()
         tempplot.get_tk_widget().grid(row=0, column=0, rowspan=40, columnspan=30, padx=10, pady=10, sticky=tk.NSEW)
         
@@ -152,6 +220,9 @@ class App(tk.Tk):
         self.ymin.set(Y_MIN_DEFAULT)
         self.ymax = tk.StringVar()
         self.ymax.set(Y_MAX_DEFAULT)
+        self.ylim = (Y_MIN_DEFAULT, Y_MAX_DEFAULT)
+        self.plot.set_ylim(*self.ylim)
+        self.animate_job = self.after(PLOT_INTERVAL, self.animate)
 
         # Dynamically determine the next row and columnspan
         next_row = frame.grid_size()[1]  # Get the next available row
@@ -167,6 +238,21 @@ class App(tk.Tk):
         tk.Label(row, text="y-max:", relief=BUTTON_STYLE, bg=BG_COLOR, font=FONT).pack(side=tk.LEFT, padx=5)
         tk.Entry(row, width=10, textvariable=self.ymax, font=FONT).pack(side=tk.LEFT, padx=5)
 
+        # Row of trace visibility toggles, same order as the plot's traces
+        toggles = tk.Frame(frame, bg=TEXT_COLOR)
+        toggles.grid(row=next_row + 1, column=0, columnspan=columnspan, pady=5)
+        self.trace_visible = []
+        for k, sensor in enumerate(self.plot.labels):
+            visible = tk.BooleanVar(value=True)
+            tk.Checkbutton(toggles, text=sensor, variable=visible, bg=TEXT_COLOR, fg=self.plot.colors[k],
+                           command=lambda k=k, v=visible: self.plot.set_visible(k, v.get())).pack(side=tk.LEFT, padx=2)
+            self.trace_visible.append(visible)
+        self.whole_run = tk.BooleanVar(value=False)
+        tk.Checkbutton(toggles, text="Whole run", variable=self.whole_run, bg=TEXT_COLOR,
+                       command=lambda: self.plot.set_follow(not self.whole_run.get())).pack(side=tk.LEFT, padx=10)
+        tk.Button(toggles, text="Live", bg=TEXT_COLOR, relief=BUTTON_STYLE,
+                  command=lambda: self.plot.set_follow(not self.whole_run.get())).pack(side=tk.LEFT, padx=2) # back from a zoom
+
         return frame
 
     def plotinitialize(self):
@@ -174,45 +260,44 @@ class App(tk.Tk):
         plt.rcParams["figure.autolayout"] = True
         plt.rcParams['font.size'] = 14
         fig, ax = plt.subplots()
-        pressure = deque([0.1], maxlen=200)
-        t_start = time.time()
-        t_array = deque([0], maxlen=200)
+        t_start = time.monotonic() # same clock as the acquisition timestamps
         sensors = ["main reactor", "inlet lower", "inlet upper", "exhaust", "TMA", "Trap", "Gauges", "Pressure"]
-        return fig, ax, pressure, t_array, t_start, sensors
+        return fig, ax, t_start, sensors
 
-    def animate(self, i):
+    def animate(self):
         try:
-            # Read data from controllers
-            tempdata = self.temp_controller.read_thermocouples()
-            pressuredata = self.pressure_controller.read_pressure()
-            logging.info([tempdata, pressuredata])
-
-            # Update pressure and time arrays
-            self.pressure.append(round(pressuredata / 10, 5))
-            self.t_array.append(time.time() - self.t_start)
-
-            # Clear and update the plot
-            self.ax.clear()
-            self.ax.plot(self.t_array, self.pressure)
-
-            # Set y-axis limits and scale
-            ymin = float(self.ymin.get())
-            ymax = float(self.ymax.get())
-            self.ax.set_ylim(ymin, ymax)
-            self.ax.set_yscale('log')
-
-            # Set plot title and x-axis limits
-            self.ax.set_title("Press q to quit")
-            self.ax.set_xlim(left=self.t_array[0], right=self.t_array[0] + 300)
-
-            # Dynamically position text annotations based on log scale
-            for j, sensor in enumerate(self.sensors[:-1]):
-                # Calculate y-position for text annotations
-                y_position = ymin * (ymax / ymin) ** (0.6 + 0.05 * j)  # Scale based on log range
-                self.ax.text(self.t_array[0] + 250, y_position, f"{sensor}, {str(tempdata[j])[:5]}")
-            self.fig.tight_layout()
+            # Latest samples from the acquisition buffers, no DAQ calls on the Tk thread
+            templatest = self.temp_controller.stream.latest()
+            pressurelatest = self.pressure_controller.stream.latest()
+            if templatest is not None and pressurelatest is not None and pressurelatest[0] > self.t_last:
+                self.t_last = pressurelatest[0]
+                pressuredata = self.pressure_controller.to_pressure(pressurelatest[1][0])
+                t, pressuredata = self.t_last - self.t_start, round(pressuredata / 10, 5)
+                self.plot.append(t, pressuredata, templatest[1])
+                self.telemetry.append(t, (pressuredata, *templatest[1]))
+
+            # y limits only touch the axes when the operator changes them
+            try:
+                ylim = (float(self.ymin.get()), float(self.ymax.get()))
+            except ValueError: # half typed entry
+                ylim = self.ylim
+            if ylim != self.ylim and 0 < ylim[0] < ylim[1]:
+                self.ylim = ylim
+                self.plot.set_ylim(*ylim)
+
+            self.plot.update()
+            self.show_progress()
         except Exception as e:
             logging.error("Error during animation: %s", e)
+        self.animate_job = self.after(PLOT_INTERVAL, self.animate)
+
+    def log_data(self, stoplog):
+        # logs the latest readings every LOG_INTERVAL, off the Tk thread
+        while not stoplog.wait(LOG_INTERVAL):
+            try:
+                logging.info([self.temp_controller.read_thermocouples(), self.pressure_controller.read_pressure()])
+            except Exception as e:
+                logging.error("Error logging data: %s", e)
 
     def create_file_controls(self):
         tk.Button(self.file_panel, text="Load File",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=self.load_file).pack(pady=5, anchor=tk.NW)
@@ -223,24 +308,17 @@ class App(tk.Tk):
         tk.Button(self.file_panel, text="Manual Control",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=self.open_manual_control).pack(pady=5, anchor=tk.NW)
 
     def create_main_power(self):
-        task = nidaqmx.Task("Main Power")
-        task.do_channels.add_do_chan(MAIN_POWER_CHANNEL, line_grouping=LineGrouping.CHAN_PER_LINE)
-        task.start()
+        task = self.do_port.line(MAIN_POWER_LINE)
         task.write(False)
-        task.stop()
         return task
 
     def toggle_main_power(self,task):
-        if self.main_power_button.config('text')[-1] == 'Main Power ON':
-            task.start()
-            task.write(False)
-            task.stop()
-            self.main_power_button.config(text='Main Power OFF',bg="red")
-        else:
-            task.start()
-            task.write(True)
-            task.stop()
+        self.main_power_on = not self.main_power_on
+        self.io.submit(task.write, self.main_power_on)
+        if self.main_power_on:
             self.main_power_button.config(text='Main Power ON',bg=ON_COLOR)
+        else:
+            self.main_power_button.config(text='Main Power OFF',bg="red")
 
     def open_manual_control(self):
         manual_control_window = tk.Toplevel(self)
@@ -252,40 +330,56 @@ class App(tk.Tk):
             frame = tk.Frame(manual_control_window, bg=BG_COLOR, pady=10)
             frame.pack(fill=tk.X, padx=10, pady=5)
             tk.Label(frame, text=valve_name, bg=BG_COLOR, font=FONT).pack(side=tk.LEFT, padx=5)
-            tk.Button(frame, text="Open",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda t=task: self.valve_controller.open_valve(t)).pack(side=tk.LEFT, padx=5)
-            tk.Button(frame, text="Close",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda t=task: self.valve_controller.close_valve(t)).pack(side=tk.LEFT, padx=5)
-            tk.Button(frame, text="Pulse",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda t=task: self.valve_controller.pulse_valve(t, 1)).pack(side=tk.LEFT, padx=5)
+            tk.Button(frame, text="Open",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda t=task: self.io.submit(self.valve_controller.open_valve, t)).pack(side=tk.LEFT, padx=5)
+            tk.Button(frame, text="Close",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda t=task: self.io.submit(self.valve_controller.close_valve, t)).pack(side=tk.LEFT, padx=5)
+            tk.Button(frame, text="Pulse",font=FONT, bg=TEXT_COLOR, relief=BUTTON_STYLE, command=lambda t=task: self.pulse_valve(t, 1)).pack(side=tk.LEFT, padx=5)
+
+    def pulse_valve(self, task, pulse_length):
+        # open now and close from a Tk timer, the worker is never tied up for the length of the pulse
+        self.io.submit(self.valve_controller.open_valve, task)
+        self.after(int(pulse_length*1000), lambda: self.io.submit(self.valve_controller.close_valve, task))
 
     def load_file(self):
         file_path = filedialog.askopenfilename(title="Select a File", filetypes=[("CSV Files", "*.csv")])
         if file_path:
             self.file_label.config(text=f"Loaded: {file_path.split('/')[-1]}")
             self.display_csv(file_path)
-        self.ald_controller.file = file_path.split('/')[-1]
+            self.ald_controller.file = file_path
+            c = self.ald_controller.checkpoint
+            if self.ald_controller.resumable(RUN_LOOPS):
+                self.run_label.config(text=f"Checkpoint at loop {c['loop']+1}, row {c['row']+1}, Resume to continue")
 
     def display_csv(self, file_path):
         for widget in self.csv_panel.winfo_children():
             widget.destroy()
         text_widget = tk.Text(self.csv_panel, wrap=tk.NONE, bg=TEXT_COLOR, height=10)
         text_widget.pack(fill=tk.BOTH, expand=True)
+        recipes = self.ald_controller.recipes # same cache the run compiles from
         try:
-            with open(file_path, newline='', encoding='utf-8') as csvfile:
-                reader = csv.reader(csvfile)
-                for row in reader:
-                    text_widget.insert(tk.END, "\t".join(row) + "\n")
+            header, rows = recipes.read(file_path)
+            for row in [header] + rows:
+                text_widget.insert(tk.END, "\t".join(row) + "\n")
+            recipes.compile(file_path) # validate now so Run Recipe starts from the cache
         except Exception as e:
             text_widget.insert(tk.END, f"Error reading file: {e}")
 
     def on_closing(self):
         print("GUI closing")
+        self.after_cancel(self.animate_job)
         plt.close(self.fig)
+        self.plot.close()
+        self.telemetry.close()
+        self.stoplog.set()
+        self.logthread.join()
+        self.io.close()
+        self.ald_controller.close() # aborts a run before the valves it drives are closed
         self.temp_controller.close()
         self.pressure_controller.close()
         self.valve_controller.close()
-        self.ald_controller.close()
         
         self.mptask.write(False)
         self.mptask.close()
+        self.do_port.close()
         
         self.destroy()
         print("Program Closed")
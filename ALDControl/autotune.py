@@ -0,0 +1,112 @@
+import json
+import logging
+import math
+import os
+import time
+
+# Relay (bang-bang) autotuning of heater PID gains
+# the heater is switched between low and high output around the setpoint, the zone settles into an
+# oscillation and its period (Pu) and amplitude give the ultimate gain Ku = 4d/(pi a), with d half the
+# relay swing and a the oscillation amplitude. The PID gains come from Ku and Pu by a tuning rule
+
+GAINS_FILE = "pid_gains.json"
+
+# rule -> (kp/Ku, Ti/Pu, Td/Pu)
+TUNING_RULES = { "ziegler-nichols": (0.6, 0.5, 0.125),
+                 "tyreus-luyben": (1/2.2, 2.2, 1/6.3), # less overshoot, suits slow thermal zones
+               }
+
+
+class wall_clock:
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class AutotuneError(RuntimeError):
+    pass
+
+
+def relay_autotune(read_temp, set_duty, setpoint, high, low=0, hysteresis=0.5, interval=1.0,
+                   cycles=4, timeout=7200.0, clock=None, stop=None):
+    ###
+    # relay_autotune(read_temp, set_duty, setpoint, high) - runs a relay experiment on one heater
+    # read_temp - returns the zone temperature (C)
+    # set_duty - sets the heater output
+    # setpoint - temperature to oscillate around (C)
+    # high, low - relay outputs, eg. tps and 0 duty ticks
+    # hysteresis - switching band either side of the setpoint (C), keeps noise from chattering the relay
+    # interval - sample time (s)
+    # cycles - oscillations measured after the first one is thrown away
+    # timeout - give up after this long (s)
+    # clock - object with time() and sleep(), eg. simulation.virtual_clock, None for the wall clock
+    # stop - optional threading.Event to abandon the experiment
+    # returns {"ku", "pu", "amplitude"}, the heater is left at low output
+    # raises AutotuneError if no steady oscillation is found
+    ###
+    clock = clock if clock is not None else wall_clock()
+    start = clock.time()
+    output = high if read_temp() < setpoint else low
+    set_duty(output)
+    switches = [] # times the relay switched to high
+    peaks = [] # (max, min) of each full cycle
+    hi = -math.inf
+    lo = math.inf
+    next_time = start
+    try:
+        while len(switches) < cycles + 2:
+            if clock.time() - start > timeout or (stop is not None and stop.is_set()):
+                raise AutotuneError(f"no steady oscillation after {clock.time() - start:.0f}s")
+            temp = read_temp()
+            hi = max(hi, temp)
+            lo = min(lo, temp)
+            if output == high and temp > setpoint + hysteresis:
+                output = low
+                set_duty(output)
+            elif output == low and temp < setpoint - hysteresis:
+                output = high
+                set_duty(output)
+                switches.append(clock.time())
+                if len(switches) > 1:
+                    peaks.append((hi, lo))
+                hi = -math.inf
+                lo = math.inf
+            next_time += interval
+            clock.sleep(next_time - clock.time())
+    finally:
+        set_duty(low)
+
+    peaks = peaks[1:] # the first cycle still carries the start up transient
+    amplitude = sum(h - l for h, l in peaks)/len(peaks)/2
+    if amplitude <= hysteresis:
+        raise AutotuneError(f"oscillation amplitude {amplitude:.3f}C is inside the hysteresis band")
+    a = math.sqrt(amplitude**2 - hysteresis**2) # relay with hysteresis correction
+    ku = 4*(high - low)/2/(math.pi*a)
+    pu = (switches[-1] - switches[1])/(len(switches) - 2)
+    logging.info(f"Relay autotune: Ku {ku:.4g}, Pu {pu:.4g}s, amplitude {amplitude:.3g}C")
+    return {"ku": ku, "pu": pu, "amplitude": amplitude}
+
+
+def pid_gains(ku, pu, rule="tyreus-luyben"):
+    # returns (kp, ki, kd) from the ultimate gain and period
+    kp_ratio, ti_ratio, td_ratio = TUNING_RULES[rule]
+    kp = kp_ratio*ku
+    return kp, kp/(ti_ratio*pu), kp*td_ratio*pu
+
+
+def load_gains(file=GAINS_FILE):
+    # {zone name: {"kp", "ki", "kd", "ku", "pu"}}, empty if nothing has been tuned yet
+    if not os.path.exists(file):
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+
+def save_gains(zone, gains, file=GAINS_FILE):
+    stored = load_gains(file)
+    stored[zone] = gains
+    with open(file, "w") as f:
+        json.dump(stored, f, indent=2)
@@ -0,0 +1,138 @@
+import nidaqmx
+from nidaqmx.constants import LineGrouping
+import threading
+from contextlib import contextmanager
+
+# every digital output line used on CDAQ1Mod4
+PORT_CHANNELS = { "AV01": "cDAQ1Mod4/line0", # TMA
+                  "AV02": "CDAQ1Mod4/line1", # D20
+                  "AV03": "CDAQ1Mod4/line2", # H20
+                  "Heater 1": "CDAQ1Mod4/port0/line5",
+                  "Heater 2": "CDAQ1Mod4/port0/line6",
+                  "Heater 3": "CDAQ1Mod4/port0/line7",
+                  "Main Power": "CDAQ1Mod4/line11",
+                }
+
+# creating a do_port object sets up one task for all the lines above, started once and kept running
+# line states are held as a bitmask and every update goes out to the DAQ in a single write,
+# so lines changed together switch in the same sample
+# do_port.line(name) hands out a do_line, which stands in for a single line nidaqmx.Task
+class do_port:
+    def __init__(self, channels=PORT_CHANNELS, name="CDAQ1Mod4"):
+        self.channels = dict(channels)
+        self.name = name
+        self.bits = {line: 1 << i for i, line in enumerate(self.channels)}
+        self.state = 0 # bitmask of line states, bit i is line i of self.channels
+        self.detached = 0 # bitmask of lines currently handed to another task
+        self.lock = threading.Lock()
+        self.task = self.create_task()
+        # log DO port initialized
+
+    def create_task(self):
+        task = nidaqmx.Task(self.name)
+        for line, channel in self.channels.items():
+            if not self.bits[line] & self.detached:
+                task.do_channels.add_do_chan(channel, line_grouping=LineGrouping.CHAN_PER_LINE)
+        task.start()
+        task.write(self.samples(self.state))
+        return task
+
+    def samples(self, state):
+        # one bool per channel in the task, in channel order
+        return [bool(state & bit) for bit in self.bits.values() if not bit & self.detached]
+
+    def update(self, on=0, off=0):
+        # set the lines in bitmask on, clear the lines in bitmask off, one write for all of them
+        with self.lock:
+            state = (self.state | on) & ~off
+            if state != self.state:
+                self.task.write(self.samples(state))
+                self.state = state
+            return state
+
+    def rewrite(self):
+        # writes the current state out again, a DAQ write that changes nothing (eg. for timing the port)
+        with self.lock:
+            self.task.write(self.samples(self.state))
+
+    def set_lines(self, states):
+        # states - {line name: bool}
+        on = off = 0
+        for line, state in states.items():
+            if state:
+                on |= self.bits[line]
+            else:
+                off |= self.bits[line]
+        return self.update(on, off)
+
+    def read_line(self, line):
+        return bool(self.state & self.bits[line])
+
+    def line(self, line):
+        return do_line(self, line)
+
+    def release(self, lines):
+        # frees the given lines for another task (eg. hardware timed output) and rebuilds the
+        # port task around the rest, which keep switching as normal. released lines are forced off first
+        mask = self.mask(lines)
+        self.update(off=mask)
+        with self.lock:
+            self.task.close()
+            self.detached |= mask
+            self.task = self.create_task()
+
+    def reclaim(self, lines):
+        # takes released lines back into the port task, they come back off
+        mask = self.mask(lines)
+        with self.lock:
+            self.task.close()
+            self.detached &= ~mask
+            self.state &= ~mask
+            self.task = self.create_task()
+
+    @contextmanager
+    def detach(self, lines):
+        # releases lines for the length of a with block
+        self.release(lines)
+        try:
+            yield
+        finally:
+            self.reclaim(lines)
+
+    def mask(self, lines):
+        mask = 0
+        for line in lines:
+            mask |= self.bits[line]
+        return mask
+
+    def close(self):
+        with self.lock:
+            self.state = 0
+            self.task.write(self.samples(0))
+            self.task.stop()
+            self.task.close()
+        print("DO Port Task Closing")
+
+
+class do_line:
+    # one line of a do_port, keeps the start()/write()/stop()/close() calls made on single line tasks working
+    # start, stop and close are no-ops, the port owns the task
+    def __init__(self, port, name):
+        self.port = port
+        self.name = name
+        self.mask = port.bits[name]
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, state):
+        if state:
+            self.port.update(on=self.mask)
+        else:
+            self.port.update(off=self.mask)
@@ -0,0 +1,43 @@
+import numpy as np
+
+# Phase staggering of heater PWM
+# every heater is on for duty ticks out of each tps tick period. Started together, all the on-times sit at
+# the front of the period and the supply sees every heater at once. Packing the on-times end to end round
+# the period instead (the next heater starts where the last one stopped, wrapping at tps) gives the lowest
+# possible peak, never more than ceil(sum(duties)/tps) heaters on at any tick
+
+
+def stagger_phases(duties, tps):
+    # returns the tick each heater's on-time starts at
+    offsets = []
+    position = 0
+    for duty in duties:
+        offsets.append(position % tps)
+        if 0 < duty < tps: # fully on or off heaters do not take up a slot
+            position += duty
+    return offsets
+
+
+def is_on(tick, duty, offset, tps):
+    return (tick - offset) % tps < duty
+
+
+def next_edge(tick, duty, offset, tps):
+    # ticks from tick to this heater's next on/off edge, None if it never switches
+    if not 0 < duty < tps:
+        return None
+    position = (tick - offset) % tps
+    return duty - position if position < duty else tps - position
+
+
+def load_profile(duties, offsets, tps, powers=None):
+    # combined load at every tick of a period, in heaters on or in watts if powers (one per heater) is given
+    ticks = np.arange(tps)
+    on = np.array([(ticks - offset) % tps < duty for duty, offset in zip(duties, offsets)], dtype=float)
+    weights = np.ones(len(duties)) if powers is None else np.asarray(powers, dtype=float)
+    return weights @ on
+
+
+def buffer(duties, offsets, tps):
+    # one period of DO samples per heater
+    return [[is_on(tick, duty, offset, tps) for tick in range(tps)] for duty, offset in zip(duties, offsets)]
@@ -0,0 +1,33 @@
+import logging
+import queue
+import threading
+
+class io_worker:
+    ###
+    # io_worker(name) - runs hardware calls on a background thread, in the order they were submitted
+    # keeps DAQ writes off the Tk thread, so a slow or timed out driver call never freezes the GUI
+    # submit(fn, *args) - queue fn(*args), returns straight away
+    # close() - runs what is already queued, then stops the thread
+    ###
+    def __init__(self, name="IO worker"):
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args):
+        self.jobs.put((fn, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"{self.thread.name}: {getattr(fn, '__name__', fn)} failed: {e}")
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
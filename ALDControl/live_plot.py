@@ -0,0 +1,169 @@
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_hex
+
+from io_worker import io_worker
+from plot_history import tiered_history
+
+PLOT_INTERVAL = 100 # ms between plot updates
+PLOT_WINDOW = 300.0 # s of time axis shown while following the newest data
+SCROLL = 0.25 # fraction of the window the time axis jumps by once the trace reaches the right edge
+TEMP_LIMITS = (0.0, 250.0) # initial temperature axis (C), widened when a zone leaves it
+TEMP_MARGIN = 25.0 # C added beyond a reading that widens the temperature axis
+PRESSURE_TRACE = 0 # trace index of pressure, temperatures follow in read_thermocouples order
+
+class live_plot:
+    ###
+    # live_plot(canvas, ax, labels) - pressure and zone temperature traces, updated in place by blitting
+    # canvas - FigureCanvasTkAgg holding ax
+    # ax - log scale pressure axes, temperatures go on a linear twin axis sharing its time axis
+    # labels - trace names, pressure first then the zones in read_thermocouples order
+    # Every trace lives in one preallocated tiered_history, full resolution for the last few minutes and a
+    # min/max envelope before that, so the whole run is always plotted from a fixed number of points
+    # The zones are a single LineCollection, so a frame is one artist however many zones are shown
+    # set_follow(False) shows the whole run instead of the last window seconds
+    # Zooming or panning with the toolbar stops the scrolling and, given a telemetry_store, asks it in the
+    # background for the visible range at one min/max pair per pixel column. The history is drawn until
+    # the answer arrives and is swapped for it on the next frame. set_follow() goes back to the live view
+    # The figure (axes, ticks, labels, layout) is drawn once into a cached background. update() restores
+    # that background and redraws only the animated artists, so a frame costs the traces and a blit
+    # instead of a full redraw and layout
+    # set_ylim(), the time axis scrolling and a zone leaving the temperature axis are the only things that
+    # redraw the whole figure. The background is captured again on every full draw, so resizing, zooming
+    # and panning keep working
+    ###
+    def __init__(self, canvas, ax, labels, window=PLOT_WINDOW, store=None):
+        self.canvas = canvas
+        self.ax = ax
+        self.fig = ax.figure
+        self.window = window
+        self.labels = labels
+        self.history = tiered_history(len(labels))
+        self.follow = True
+        self.store = store
+        self.query_worker = io_worker("plot query") if store is not None else None
+        self.zoomed = False # the operator moved the time axis, stop scrolling it
+        self.scrolling = False # our own set_xlim, not a zoom
+        self.request = 0 # newest view asked for, older queries still queued are skipped
+        self.detail = None # (request, channels x points x 2) from the store, None until one arrives
+        self.visible = [True]*len(labels)
+        self.background = None
+
+        ax.set_yscale('log')
+        ax.set_ylabel("Pressure")
+        ax.set_title("Press q to quit")
+        ax.set_xlim(0, window)
+        self.tax = ax.twinx()
+        self.tax.set_ylabel("Temperature (C)")
+        self.tax.set_ylim(*TEMP_LIMITS)
+
+        self.colors = [to_hex(f"C{k}") for k in range(len(labels))] # hex so Tk widgets can share them
+        self.line, = ax.plot([], [], color=self.colors[PRESSURE_TRACE], animated=True)
+        self.zones = LineCollection([], colors=self.colors[1:], animated=True)
+        self.tax.add_collection(self.zones)
+        # readouts sit at fixed axes coordinates, so changing the y limits never moves them
+        self.texts = [ax.text(250/300, 0.6 + 0.05*j, "", color=self.colors[j + 1], transform=ax.transAxes, animated=True)
+                      for j in range(len(labels) - 1)]
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        ax.callbacks.connect('xlim_changed', self.on_xlim)
+
+    def on_draw(self, event):
+        # every full draw (first show, resize, zoom, set_ylim) leaves a clean background to blit onto
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        self.ax.draw_artist(self.line)
+        self.tax.draw_artist(self.zones)
+        for text in self.texts:
+            self.ax.draw_artist(text)
+
+    def set_ylim(self, ymin, ymax):
+        self.ax.set_ylim(ymin, ymax)
+        self.fig.tight_layout() # figure.autolayout also relayouts on resize
+        self.canvas.draw_idle()
+
+    def set_visible(self, trace, visible):
+        # shows or hides one trace, hidden zones are left out of the collection rather than drawn empty
+        self.visible[trace] = visible
+        if trace == PRESSURE_TRACE:
+            self.line.set_visible(visible)
+        else:
+            self.texts[trace - 1].set_visible(visible)
+            self.zones.set_colors([c for c, v in zip(self.colors[1:], self.visible[1:]) if v])
+
+    def set_follow(self, follow):
+        # follow - True to scroll with the last window seconds, False to fit the whole run
+        self.follow = follow
+        self.zoomed = False
+        self.detail = None
+        span = self.history.span()
+        if span is not None:
+            self.scroll(span[1], force=True)
+
+    def scroll(self, t, force=False):
+        # moves the time axis so t is in view, a full redraw, so it jumps ahead rather than creeping
+        left, right = self.ax.get_xlim()
+        if (t <= right or self.zoomed) and not force:
+            return
+        if self.follow:
+            left = t - self.window*(1 - SCROLL)
+            right = left + self.window
+        else:
+            left = min(self.history.span()[0], t - self.window)
+            right = t + (t - left)*SCROLL
+        self.scrolling = True
+        self.ax.set_xlim(left, right)
+        self.scrolling = False
+        self.canvas.draw_idle()
+
+    def on_xlim(self, ax):
+        # toolbar zoom, pan, back or home
+        if self.scrolling:
+            return
+        self.zoomed = True
+        if self.store is None:
+            return
+        self.request += 1
+        left, right = ax.get_xlim()
+        self.query_worker.submit(self.fetch, self.request, left, right, int(ax.bbox.width))
+
+    def fetch(self, request, left, right, columns):
+        # runs on the query worker, a pan queues a view per frame and only the newest is worth reading
+        if request != self.request:
+            return
+        self.detail = (request, self.store.query(left, right, columns))
+
+    def append(self, t, pressure, temps):
+        # t - seconds on the plot's time axis, pressure - one value, temps - one value per zone
+        self.history.append(t, (pressure, *temps))
+        for text, label, temp in zip(self.texts, self.labels[1:], temps):
+            text.set_text(f"{label}, {temp:.1f}")
+
+        bottom, top = self.tax.get_ylim()
+        low, high = np.nanmin(temps, initial=bottom), np.nanmax(temps, initial=top)
+        if low < bottom or high > top: # rare, a zone heated or cooled past the axis
+            self.tax.set_ylim(min(bottom, low - TEMP_MARGIN), max(top, high + TEMP_MARGIN))
+            self.canvas.draw_idle()
+
+        self.scroll(t) # the only regular full redraw while running
+
+    def points(self, trace):
+        # the store's answer for the zoomed view once there is one, otherwise the in memory history
+        detail = self.detail
+        if self.zoomed and detail is not None and detail[1] is not None:
+            return detail[1][trace]
+        return self.history.points(trace)
+
+    def update(self):
+        self.line.set_data(*self.points(PRESSURE_TRACE).T)
+        self.zones.set_segments([self.points(k) for k in range(1, len(self.labels)) if self.visible[k]])
+        if self.background is None: # nothing drawn yet, on_draw will draw the artists
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.fig.bbox)
+
+    def close(self):
+        if self.query_worker is not None:
+            self.query_worker.close()
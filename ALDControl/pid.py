@@ -0,0 +1,58 @@
+import numpy as np
+
+class pid_controller:
+    ###
+    # pid_controller(kp, ki, kd, out_min, out_max) - a bank of PID loops computed together in one numpy step
+    # kp, ki, kd - gains, one per loop (output units per degree, per degree second, per degree/second)
+    # out_min, out_max - output clamp, eg. 0 and temp_controller.tps for heater duties
+    # setpoints - one per loop, nan switches a loop off (its output is held at out_min)
+    # the derivative acts on the measurement so setpoint steps do not kick the output, and the
+    # integral is frozen while the output is saturated in the direction the error pushes (anti-windup)
+    # a nan or inf measurement (eg. no thermocouple sample yet) holds that loop's integral and output
+    ###
+    def __init__(self, kp, ki, kd, out_min=0.0, out_max=1.0, setpoints=None):
+        self.kp = np.asarray(kp, dtype=float)
+        self.ki = np.broadcast_to(np.asarray(ki, dtype=float), self.kp.shape).copy()
+        self.kd = np.broadcast_to(np.asarray(kd, dtype=float), self.kp.shape).copy()
+        self.out_min = out_min
+        self.out_max = out_max
+        self.setpoints = np.full(self.kp.shape, np.nan)
+        if setpoints is not None:
+            self.setpoints[:] = setpoints
+        self.reset()
+
+    def reset(self):
+        self.integral = np.zeros(self.kp.shape)
+        self.last = None # last measurement
+        self.output = np.full(self.kp.shape, float(self.out_min))
+
+    def set_setpoint(self, loop, setpoint):
+        # setpoint - None switches the loop off
+        self.setpoints[loop] = np.nan if setpoint is None else setpoint
+        if setpoint is None:
+            self.integral[loop] = 0.0
+
+    def preload(self, loop, output):
+        # starts a loop's integral at output, for a bumpless hand over from open loop
+        self.integral[loop] = min(max(output, self.out_min), self.out_max)
+
+    def update(self, measurement, dt):
+        # measurement - one reading per loop, dt - seconds since the last update
+        # returns the clamped outputs
+        pv = np.asarray(measurement, dtype=float)
+        good = np.isfinite(pv)
+        on = ~np.isnan(self.setpoints)
+        error = np.where(on & good, self.setpoints - pv, 0.0)
+        last = np.full(pv.shape, np.nan) if self.last is None else self.last
+        valid = good & np.isfinite(last)
+        derivative = np.where(valid, -(np.where(valid, pv, 0.0) - np.where(valid, last, 0.0))/dt, 0.0)
+        self.last = np.where(good, pv, last) # keeps the last good reading of a masked loop
+
+        integral = self.integral + self.ki*error*dt
+        raw = self.kp*error + integral + self.kd*derivative
+        windup = ((raw > self.out_max) & (error > 0)) | ((raw < self.out_min) & (error < 0))
+        self.integral = np.clip(np.where(windup | ~on | ~good, self.integral, integral), self.out_min, self.out_max)
+
+        output = np.clip(self.kp*error + self.integral + self.kd*derivative, self.out_min, self.out_max)
+        self.output = np.where(on, np.where(good, output, self.output), self.out_min)
+        return self.output
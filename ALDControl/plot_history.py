@@ -0,0 +1,73 @@
+import numpy as np
+
+RECENT_POINTS = 3000 # newest samples kept at full resolution, 300 s at the 10 Hz plot rate
+ENVELOPE_BUCKETS = 1000 # min/max buckets for everything older, about one per pixel column of the plot
+BUCKET_POINTS = 30 # recent samples folded into one bucket, 3 s at 10 Hz
+
+class tiered_history:
+    ###
+    # tiered_history(traces) - fixed size plot history of any length, recent samples at full resolution,
+    # older ones as a min/max envelope
+    # traces - number of traces, every trace gets its own timestamps so an envelope point sits where
+    # its min or max actually happened
+    # xy[trace, point] = (t, value), oldest first, points [0, count) valid:
+    #   [0, envelope) - two points per bucket, the bucket's min and max in the order they happened
+    #   [envelope, count) - the newest samples as they were appended
+    # Once RECENT_POINTS samples are held the oldest BUCKET_POINTS of them are folded into a bucket.
+    # Once every bucket is used neighbouring buckets are merged in pairs, halving the envelope's
+    # resolution, so the history never holds more than 2*buckets + recent points however long a run is.
+    # A spike survives every fold and merge as the max of its bucket
+    ###
+    def __init__(self, traces, recent=RECENT_POINTS, buckets=ENVELOPE_BUCKETS, block=BUCKET_POINTS):
+        if buckets % 2 or block < 2:
+            raise ValueError("buckets must be even and block at least 2")
+        self.recent = recent
+        self.buckets = buckets
+        self.block = block
+        self.xy = np.full((traces, 2*buckets + recent, 2), np.nan)
+        self.envelope = 0
+        self.count = 0
+
+    def append(self, t, values):
+        # t - timestamp, values - one value per trace
+        if self.count - self.envelope == self.recent:
+            self.fold()
+        self.xy[:, self.count, 0] = t
+        self.xy[:, self.count, 1] = values
+        self.count += 1
+
+    def minmax(self, groups):
+        # groups - traces x n x k x 2 points, returns traces x n x 2 x 2, the min and max point of each group
+        values = groups[..., 1]
+        imin, imax = values.argmin(axis=-1), values.argmax(axis=-1)
+        order = np.stack([np.minimum(imin, imax), np.maximum(imin, imax)], axis=-1)
+        return np.take_along_axis(groups, order[..., None], axis=-2)
+
+    def fold(self):
+        # turns the oldest block of recent samples into one bucket
+        if self.envelope == 2*self.buckets:
+            self.merge()
+        e, block = self.envelope, self.block
+        self.xy[:, e:e + 2] = self.minmax(self.xy[:, None, e:e + block])[:, 0]
+        self.xy[:, e + 2:self.count - block + 2] = self.xy[:, e + block:self.count]
+        self.envelope += 2
+        self.count -= block - 2
+
+    def merge(self):
+        # merges neighbouring buckets in pairs, the envelope shrinks to half its points
+        half = self.buckets
+        pairs = self.xy[:, :2*half].reshape(len(self.xy), half//2, 4, 2)
+        self.xy[:, :half] = self.minmax(pairs).reshape(len(self.xy), half, 2)
+        self.xy[:, half:self.count - half] = self.xy[:, 2*half:self.count]
+        self.envelope = half
+        self.count -= half
+
+    def points(self, trace):
+        # view of one trace's valid points, ready for Line2D.set_data(*points.T) or a LineCollection
+        return self.xy[trace, :self.count]
+
+    def span(self):
+        # (first, last) timestamp held, None while empty
+        if not self.count:
+            return None
+        return self.xy[0, 0, 0], self.xy[0, self.count - 1, 0]
@@ -5,12 +5,23 @@ import logging
 import time
 import threading
 
+from acquisition import acquisition_stream
+
+PRESSURE_RATE = 1000.0 # Hz when acquiring continuously
+PRESSURE_BLOCK = 100 # samples per read, 10 reads a second
+PRESSURE_DECIMATE = 100 # the main buffer keeps 10Hz means, full rate only inside burst windows
+PRESSURE_CAPACITY = 144000 # decimated samples kept, 4 hours at 10Hz
+BURST_CAPACITY = 600000 # full rate burst samples kept, about 1000 pulse windows
+BURST_PRE = 0.05 # s of full rate data kept before a valve opens
+BURST_POST = 0.5 # s after
+
 class pressure_controller:
     def __init__(self):
         pressure_sensor_channel={"Pchannel":"cDAQ1Mod2/ai2"}
         self.ptask = nidaqmx.Task("Pressure")
         self.ptask.ai_channels.add_ai_voltage_chan(pressure_sensor_channel["Pchannel"], min_val=-10.0, max_val=10.0)
         self.ptask.start()
+        self.stream = None # acquisition_stream once start_acquisition() is called
         # Add flow controller functionality?
 
         #log pressure controller initialized
@@ -23,9 +34,30 @@ class pressure_controller:
 
     #def log_cfm():
 
+    def start_acquisition(self, rate=PRESSURE_RATE, block=PRESSURE_BLOCK, capacity=PRESSURE_CAPACITY,
+                          decimate=PRESSURE_DECIMATE, burst_capacity=BURST_CAPACITY):
+        # switches the gauge to continuous sample clocked acquisition into self.stream.buffer (volts),
+        # read_pressure() then returns the newest sample instead of reading the DAQ
+        # full rate samples around valve openings go to self.stream.bursts, see on_valve()
+        self.stream = acquisition_stream(self.ptask, rate, block, capacity, decimate, burst_capacity)
+        self.stream.start()
+        return self.stream
+
+    def on_valve(self, valve, state, t):
+        # valve_controller listener, opens a full rate burst window around every valve opening
+        if state and self.stream is not None:
+            self.stream.trigger(t, BURST_PRE, BURST_POST, tag=valve)
+
+    def to_pressure(self, voltage):
+        return voltage/10
+
     def read_pressure(self):
-        voltage = self.ptask.read()
-        pressure = voltage/10
+        if self.stream is not None:
+            latest = self.stream.latest()
+            voltage = float(latest[1][0]) if latest is not None else float("nan") # plain float, as nidaqmx gives
+        else:
+            voltage = self.ptask.read()
+        pressure = self.to_pressure(voltage)
         return pressure
     
     def readPressure_pdr2000(self):
@@ -37,5 +69,7 @@ class pressure_controller:
         return pressure
     
     def close(self):
+        if self.stream is not None:
+            self.stream.stop()
         self.ptask.close()
         print("Pressure Task Closing")
\ No newline at end of file
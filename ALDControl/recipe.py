@@ -0,0 +1,198 @@
+import csv
+import math
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+# Recipe files are CSVs with one column per ALD valve and a Delay column, eg.
+#   AV01,AV02,AV03,Delay
+#   1,-1,-1,0.2
+# A valve cell of -1 leaves the valve alone for that row, a cell over PULSE_THRESHOLD
+# pulses the valve for the row's Delay (seconds). Rows with no pulses are plain waits.
+
+VALVE_COLUMNS = ("AV01", "AV02", "AV03") # same order as valve_controller.tasks
+DELAY_COLUMN = "Delay"
+SKIP = -1
+PULSE_THRESHOLD = 0.04 # cells at or under 40ms are not pulsed
+HW_RATE = 1000.0 # default DO sample clock for hardware timed runs (Hz), 1ms pulse resolution
+
+# row - line of the csv the step came from (header excluded, 0 based)
+# start - offset of the step from the start of a cycle (s)
+# duration - length of the step (s)
+# pulses - tuple of (valve index, pulse length) pairs to fire at the start of the step
+recipe_step = namedtuple("recipe_step", ["row", "start", "duration", "pulses"])
+
+# file - path the recipe was compiled from
+# steps - tuple of recipe_step, in execution order
+# cycle_time - length of one pass through the recipe (s)
+recipe = namedtuple("recipe", ["file", "steps", "cycle_time"])
+
+
+# time - offset of the event from the start of a cycle (s)
+# states - tuple of (valve index, open) pairs switched together at that time
+# row - recipe row the event belongs to
+valve_event = namedtuple("valve_event", ["time", "states", "row"])
+
+
+class RecipeError(ValueError):
+    pass
+
+
+def read_recipe(file):
+    # returns the header and data rows of a recipe csv as lists of strings
+    with open(file, newline='', encoding='utf-8-sig') as csvfile: # utf-8-sig drops the BOM excel writes
+        rows = [row for row in csv.reader(csvfile) if any(cell.strip() for cell in row)]
+    if not rows:
+        raise RecipeError(f"{file}: recipe is empty")
+    return [cell.strip() for cell in rows[0]], rows[1:]
+
+
+def compile_rows(header, rows, file="<recipe>", threshold=PULSE_THRESHOLD):
+    missing = [c for c in VALVE_COLUMNS + (DELAY_COLUMN,) if c not in header]
+    if missing:
+        raise RecipeError(f"{file}: missing column(s) {', '.join(missing)}")
+    unknown = [c for c in header if c not in VALVE_COLUMNS + (DELAY_COLUMN,)]
+    if unknown:
+        raise RecipeError(f"{file}: unknown column(s) {', '.join(unknown)}")
+    if not rows:
+        raise RecipeError(f"{file}: recipe has no steps")
+
+    valve_index = [header.index(c) for c in VALVE_COLUMNS]
+    delay_index = header.index(DELAY_COLUMN)
+
+    steps = []
+    start = 0.0
+    for j, row in enumerate(rows):
+        if len(row) != len(header):
+            raise RecipeError(f"{file}: row {j+1} has {len(row)} cells, expected {len(header)}")
+        try:
+            cells = [float(cell) for cell in row]
+        except ValueError:
+            raise RecipeError(f"{file}: row {j+1} has a non-numeric cell: {row}") from None
+
+        delay = cells[delay_index]
+        if not math.isfinite(delay) or delay < 0:
+            raise RecipeError(f"{file}: row {j+1} has an invalid Delay {delay}")
+
+        pulses = []
+        for k, c in enumerate(valve_index):
+            if cells[c] == SKIP:
+                continue
+            if not math.isfinite(cells[c]) or cells[c] < 0:
+                raise RecipeError(f"{file}: row {j+1} has an invalid {VALVE_COLUMNS[k]} value {cells[c]}")
+            if cells[c] > threshold:
+                pulses.append((k, delay))
+
+        steps.append(recipe_step(j, start, delay, tuple(pulses)))
+        start += delay
+    return recipe(file, tuple(steps), start)
+
+
+def compile_recipe(file, threshold=PULSE_THRESHOLD):
+    ###
+    # compile_recipe(file) - parses and validates a recipe csv into an immutable recipe
+    # file - path to the recipe csv
+    # threshold - valve cells must be above this to pulse the valve
+    # raises RecipeError if the file does not match the recipe schema
+    ###
+    header, rows = read_recipe(file)
+    return compile_rows(header, rows, file, threshold)
+
+
+class recipe_cache:
+    ###
+    # recipe_cache(size) - least recently used cache of parsed and compiled recipes
+    # size - number of recipe files kept
+    # entries are keyed by path and checked against the file's mtime and size on every lookup,
+    # so an edited recipe is parsed again while an unchanged one costs a single os.stat
+    # shared by the GUI's recipe display and ald_controller, safe to use from several threads
+    ###
+    def __init__(self, size=8):
+        self.size = size
+        self.entries = OrderedDict() # path -> [stamp, header, rows, {threshold: recipe}]
+        self.lock = threading.Lock()
+
+    def entry(self, file):
+        path = os.path.abspath(file)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(path)
+                return entry
+        header, rows = read_recipe(path) # parse outside the lock, other recipes stay available
+        entry = [stamp, header, rows, {}]
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def read(self, file):
+        # header and data rows of a recipe csv as strings, for display
+        _, header, rows, _ = self.entry(file)
+        return header, rows
+
+    def compile(self, file, threshold=PULSE_THRESHOLD):
+        # same as compile_recipe, a compiled recipe is only built once per file version and threshold
+        entry = self.entry(file)
+        compiled = entry[3].get(threshold)
+        if compiled is None:
+            compiled = compile_rows(entry[1], entry[2], file, threshold)
+            entry[3][threshold] = compiled
+        return compiled
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = recipe_cache() # shared default cache
+
+
+def valve_events(recipe):
+    ###
+    # valve_events(recipe) - flattens one recipe cycle into valve switching events, in time order
+    # every valve pulsed in a row opens together at the start of the row and closes at its own time,
+    # so co-dosed valves overlap instead of running back to back
+    # a valve closing and reopening at the same instant keeps the close first
+    ###
+    events = []
+    for step in recipe.steps:
+        if not step.pulses:
+            continue
+        events.append(valve_event(step.start, tuple((k, True) for k, _ in step.pulses), step.row))
+        closes = {}
+        for k, length in step.pulses:
+            closes.setdefault(step.start + length, []).append((k, False))
+        for t in sorted(closes):
+            events.append(valve_event(t, tuple(closes[t]), step.row))
+    events.sort(key=lambda e: e.time) # stable, so closes stay ahead of opens at the same time
+    return tuple(events)
+
+
+def render_waveform(recipe, rate=HW_RATE, cycles=1, tail=True):
+    ###
+    # render_waveform(recipe, rate, cycles) - renders recipe cycles into a sample clocked DO waveform
+    # recipe - compiled recipe
+    # rate - DO sample clock rate (Hz)
+    # cycles - number of back to back recipe cycles to render
+    # tail - end on one extra sample with every valve closed, only the last block of a run needs it,
+    #        blocks streamed back to back without it take exactly cycles*cycle_time
+    # returns one list of bools per valve line, ready for task.write on a CHAN_PER_LINE task
+    ###
+    cycle_samples = int(round(recipe.cycle_time*rate))
+    data = np.zeros((len(VALVE_COLUMNS), cycle_samples*cycles + int(tail)), dtype=bool)
+    for step in recipe.steps:
+        for k, length in step.pulses:
+            first = int(round(step.start*rate))
+            last = int(round((step.start + length)*rate))
+            if last <= first:
+                raise RecipeError(f"{recipe.file}: row {step.row+1} pulse of {length}s is shorter than one sample at {rate}Hz")
+            for i in range(cycles):
+                data[k, i*cycle_samples + first:i*cycle_samples + last] = True
+    return data.tolist()
@@ -0,0 +1,55 @@
+import time
+
+SPIN_TIME = 0.0003 # busy-wait the last 300us before a deadline, time.sleep overshoots more than that
+POLL_TIME = 0.01 # longest single sleep while an interrupt event is watched, the most a pause or abort waits
+
+class deadline_scheduler:
+    ###
+    # deadline_scheduler(spin, clock, sleep) - waits for absolute deadlines measured from start()
+    # spin - seconds before each deadline to stop sleeping and busy-wait, 0 to only sleep
+    # clock - monotonic time source (s)
+    # sleep - sleep function matching clock
+    # interrupt - optional threading.Event, setting it cuts the current wait short (wait_until returns None)
+    #             it is checked between sleeps of at most POLL_TIME. Event.wait is not used to sleep, it
+    #             overshoots more than time.sleep (whole milliseconds on Windows)
+    # every wait is measured against the run start, so sleep overshoot and step overhead
+    # never accumulate from one step to the next
+    ###
+    def __init__(self, spin=SPIN_TIME, clock=time.monotonic, sleep=time.sleep, interrupt=None):
+        self.spin = spin
+        self.clock = clock
+        self.interrupt = interrupt
+        self.sleep = sleep
+        self.start_time = None
+
+    def start(self, offset=0.0):
+        # offset - where on the timeline to start from, eg. when resuming part way through a run
+        self.start_time = self.clock() - offset
+        return self.start_time
+
+    def rebase(self, offset):
+        # moves the timeline so offset is now
+        self.start_time = self.clock() - offset
+
+    def interrupted(self):
+        return self.interrupt is not None and self.interrupt.is_set()
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def wait_until(self, offset):
+        # sleeps until start_time + offset and returns how late we woke up (s)
+        deadline = self.start_time + offset
+        remaining = deadline - self.clock()
+        if self.interrupted():
+            return None
+        while remaining > self.spin:
+            self.sleep(min(remaining - self.spin, POLL_TIME) if self.interrupt is not None else remaining - self.spin)
+            if self.interrupted():
+                return None
+            remaining = deadline - self.clock()
+        if self.spin:
+            while self.clock() < deadline:
+                if self.interrupted():
+                    return None
+        return self.clock() - deadline
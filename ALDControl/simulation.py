@@ -0,0 +1,122 @@
+import numpy as np
+
+from ald_controller import ald_controller
+from recipe import HW_RATE, VALVE_COLUMNS
+
+# Dry runs of recipes in virtual time, no DAQ needed
+#   events, duration = dry_run("testrecipe.csv", 100)
+# events - list of (time, valve name, open) for every valve change, time in seconds from the run start
+# duration - length of the run in seconds
+
+
+class virtual_clock:
+    # stands in for time.monotonic/time.sleep, sleeping just moves the clock forward
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class sim_valve:
+    # one simulated valve line, mirrors the task interface valve_controller hands out
+    def __init__(self, controller, name):
+        self.controller = controller
+        self.name = name
+        self.state = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, state):
+        state = bool(state)
+        if state != self.state:
+            self.state = state
+            self.controller.events.append((self.controller.clock.time(), self.name, state))
+
+
+class sim_valve_controller:
+    ###
+    # sim_valve_controller(clock) - drop-in for valve_controller that records valve changes instead of driving the DAQ
+    # clock - virtual_clock the run is timed against
+    # self.events - (time, valve name, open) for every valve change
+    ###
+    def __init__(self, clock):
+        self.clock = clock
+        self.valvechannels = {name: name for name in VALVE_COLUMNS}
+        self.tasks = [sim_valve(self, name) for name in VALVE_COLUMNS]
+        self.events = []
+        self.timing = None
+
+    def open_valve(self,task):
+        task.write(True)
+
+    def close_valve(self,task):
+        task.write(False)
+
+    def set_valve(self,task,state):
+        task.write(state)
+
+    def set_valves(self,states,planned=None):
+        for k, state in states.items():
+            self.tasks[k].write(state)
+        if planned is not None and self.timing is not None:
+            self.timing.mark(planned, states)
+
+    def pulse_valve(self,task,pulse_length):
+        task.write(True)
+        self.clock.sleep(pulse_length)
+        task.write(False)
+
+    def play_waveform(self, data, rate, stop=None):
+        return self.play_waveform_blocks([data], rate, stop) == 1
+
+    def play_waveform_blocks(self, blocks, rate, stop=None, progress=None):
+        # replays the edges of each block back to back, the clock ends where the DAQ would finish
+        # like the DAQ there is no gap between blocks, a set stop ends the run at the next block boundary
+        for played, data in enumerate(blocks):
+            if stop is not None and stop.is_set():
+                return played
+            start = self.clock.time()
+            lines = np.asarray(data, dtype=bool)
+            previous = np.array([task.state for task in self.tasks])[:, None]
+            edges = np.diff(np.hstack([previous, lines]).astype(np.int8), axis=1) != 0
+            for i in np.flatnonzero(edges.any(axis=0)):
+                self.clock.now = start + int(i)/rate
+                for k in np.flatnonzero(edges[:, i]):
+                    self.tasks[k].write(lines[k, i])
+            self.clock.now = start + lines.shape[1]/rate
+            if progress is not None:
+                progress(played + 1)
+        return len(blocks)
+
+    def close_all(self):
+        for task in self.tasks:
+            task.write(False)
+
+    def close(self):
+        self.close_all()
+
+
+def dry_run(file, loops, hardware_timed=False, rate=HW_RATE, block=1):
+    ###
+    # dry_run(file, loops) - runs a recipe through ald_controller in virtual time
+    # returns the valve event timeline and the total run duration (s)
+    # raises RecipeError for recipes that would be refused on the tool
+    ###
+    clock = virtual_clock()
+    vc = sim_valve_controller(clock)
+    ald = ald_controller(clock=clock)
+    ald.file = file
+    ald.aldRun(loops, vc, hardware_timed=hardware_timed, rate=rate, block=block)
+    return vc.events, clock.time()
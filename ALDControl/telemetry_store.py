@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from io_worker import io_worker
+
+FLUSH_ROWS = 100 # rows buffered before a write, 10 s at the 10 Hz plot rate
+
+class telemetry_store:
+    ###
+    # telemetry_store(channels, file) - append only on-disk record of every plotted sample
+    # channels - values per row, rows are stored as (t, value, value, ...) float64
+    # file - path of the flat binary file, defaults to telemetry_<date>_<time>.bin in the working directory
+    # append() only copies into a preallocated block, full blocks are written by a background io_worker
+    # query(t0, t1, columns) reads the file through np.memmap, so only the rows in [t0, t1] are touched and
+    # a multi-hour run is never loaded into memory. Rows are appended in time order, so the range is found
+    # by binary search and decimated to a min/max pair per column
+    # rows still in the block are not visible to query() until they are written
+    ###
+    def __init__(self, channels, file=None, flush_rows=FLUSH_ROWS):
+        self.file = file or time.strftime("telemetry_%Y%m%d_%H%M%S.bin")
+        self.width = channels + 1
+        self.block = np.empty((flush_rows, self.width))
+        self.pending = 0
+        self.written = 0 # rows on disk, only grows once their write has finished
+        self.handle = open(self.file, "ab")
+        self.lock = threading.Lock() # rows on disk vs. a query opening the memmap
+        self.writer = io_worker("telemetry writer")
+
+    def append(self, t, values):
+        self.block[self.pending, 0] = t
+        self.block[self.pending, 1:] = values
+        self.pending += 1
+        if self.pending == len(self.block):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.writer.submit(self.write, self.block[:self.pending])
+            self.block = np.empty_like(self.block) # the full block now belongs to the writer
+            self.pending = 0
+
+    def write(self, rows):
+        self.handle.write(rows.tobytes())
+        self.handle.flush()
+        with self.lock:
+            self.written += len(rows)
+
+    def rows(self):
+        # memmap of every row written so far, None while the file is empty
+        with self.lock:
+            n = self.written
+        if not n:
+            return None
+        return np.memmap(self.file, dtype=float, mode="r", shape=(n, self.width))
+
+    def query(self, t0, t1, columns):
+        ###
+        # query(t0, t1, columns) - recorded samples between t0 and t1, at most two points per column
+        # returns a channels x points x 2 array of (t, value), or None if nothing was recorded in the range
+        # the rows either side of the range are included so lines run to the edges of the view
+        # each column keeps its min and max at their own timestamps, so spikes are never averaged away
+        ###
+        rows = self.rows()
+        if rows is None:
+            return None
+        times = rows[:, 0]
+        first = max(np.searchsorted(times, t0) - 1, 0)
+        last = min(np.searchsorted(times, t1, side="right") + 1, len(rows))
+        n = last - first
+        if n <= 0:
+            return None
+        columns = max(int(columns), 1)
+        size = n//columns
+        if size < 2: # already no more than two points per column
+            data = np.asarray(rows[first:last])
+            return np.stack([np.broadcast_to(data[:, :1], data[:, 1:].shape), data[:, 1:]], axis=-1).transpose(1, 0, 2)
+
+        head = np.asarray(rows[first:first + size*columns]).reshape(columns, size, self.width)
+        values = head[:, :, 1:] # columns x size x channels
+        imin, imax = values.argmin(axis=1), values.argmax(axis=1)
+        order = np.stack([np.minimum(imin, imax), np.maximum(imin, imax)], axis=1) # columns x 2 x channels
+        t = np.take_along_axis(head[:, :, :1], order, axis=1)
+        v = np.take_along_axis(values, order, axis=1)
+        points = np.stack([t, v], axis=-1).reshape(columns*2, -1, 2) # points x channels x 2
+        tail = np.asarray(rows[first + size*columns:last]) # fewer than size rows left over
+        tail = np.stack([np.broadcast_to(tail[:, :1], tail[:, 1:].shape), tail[:, 1:]], axis=-1)
+        return np.concatenate([points, tail]).transpose(1, 0, 2)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.handle.close()
+        if not os.path.getsize(self.file):
+            os.remove(self.file)
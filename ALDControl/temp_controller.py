@@ -4,15 +4,55 @@ from nidaqmx.constants import (
     CJCSource,
     TemperatureUnits,
     ThermocoupleType,
-    LineGrouping
+    LineGrouping,
+    RegenerationMode
 )
 import queue
 import logging
+from collections import deque
 import time
 import threading
 
+import numpy as np
+
+import autotune
+from acquisition import acquisition_stream
+import heater_phase
+import thermal
+from pid import pid_controller
+
+HEATER_LINES = ["Heater 1", "Heater 2", "Heater 3"] # line names in do_port.PORT_CHANNELS
+SENSORS = ["main reactor", "inlet lower", "inlet upper", "exhaust", "TMA", "Trap", "Gauges"] # thermocouples ai0-ai6
+HEATER_ZONES = [0, 1, 4] # thermocouple each heater is controlled from, match to the wiring
+PID_GAINS = [(10.0, 0.1, 0.0), # kp (ticks/C), ki (ticks/C s), kd (ticks s/C) for each heater
+             (10.0, 0.1, 0.0),
+             (10.0, 0.1, 0.0)]
+PID_INTERVAL = 1.0 # seconds between PID updates, one PWM period
+HISTORY_LENGTH = 36000 # thermocouple reads kept for fitting zone models
+THERMOCOUPLE_RATE = 2.0 # Hz per channel when acquiring continuously
+THERMOCOUPLE_BLOCK = 1 # samples per channel per read
+THERMOCOUPLE_CAPACITY = 28800 # samples kept, 4 hours at 2Hz
+HEATER_POWER = None # watts per heater for load_report, None reports the number of heaters on
+
+class duty_queue(queue.Queue):
+    # heater duty queue that also sets an event on every put, so the heater engine can sleep until
+    # a duty actually changes instead of polling
+    def __init__(self, event):
+        super().__init__()
+        self.event = event
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.event.set()
+
+# port - optional do_port shared with the other CDAQ1Mod4 lines, heater writes then go through its single task
+# pwm - "software" times the duty cycles from a thread (heater_cycle), "hardware" hands them to the DAQ as a
+#       continuously regenerated DO buffer (heater_buffer_cycle), the thread then only wakes to rewrite the
+#       buffer when a duty changes and the heaters keep cycling however busy the process is
+# stagger - spread the heaters' on-times round the period (see heater_phase) instead of switching them all on
+#           at tick 0, to flatten the peak load on the heater supply
 class temp_controller:
-    def __init__(self):
+    def __init__(self, port=None, pwm="software", stagger=True):
         # log temperature controller intialized
         print("Temperature Controller Initializing")
 
@@ -29,6 +69,21 @@ class temp_controller:
         self.tempchannels = ["ai0", "ai1", "ai2", "ai3", "ai4", "ai5", "ai6"]
 
         self.tps = 200 # ticks per second for duty cycles
+        self.port = port
+        self.pwm = pwm
+        self.stagger = stagger
+        self.offsets = [0]*len(self.channels) # tick each heater's on-time starts at
+        self.duty_event = threading.Event() # set whenever a duty is queued
+        self.read_lock = threading.Lock() # the GUI and the PID loop both read the thermocouples
+        self.heater_zones = list(HEATER_ZONES)
+        self.pid = pid_controller(*zip(*PID_GAINS), out_min=0, out_max=self.tps)
+        self.pidthread = None
+        self.load_gains()
+        self.duties = [0]*len(self.channels) # duty the heater engine is running, per heater
+        self.history = deque(maxlen=HISTORY_LENGTH) # (time, temperatures, duties) for every thermocouple read
+        self.zone_models = {} # heater -> thermal.zone_model
+        self.preheatthread = None
+        self.stream = None # acquisition_stream once start_acquisition() is called
 
         self.queues = self.create_heater_queue()
         self.tasks = self.create_heater_tasks()
@@ -36,12 +91,16 @@ class temp_controller:
         self.thermocoupletask = self.create_thermocouple_tasks()
 
     def create_heater_queue(self):
-        h1queue = queue.Queue()
-        h2queue = queue.Queue()
-        h3queue = queue.Queue()
+        h1queue = duty_queue(self.duty_event)
+        h2queue = duty_queue(self.duty_event)
+        h3queue = duty_queue(self.duty_event)
         return [h1queue,h2queue,h3queue]
 
     def create_heater_tasks(self):
+        if self.pwm == "hardware":
+            return [self.create_heater_buffer_task()]
+        if self.port is not None:
+            return [self.port.line(line) for line in HEATER_LINES]
         h1task = nidaqmx.Task("Heater 1")
         h2task = nidaqmx.Task("Heater 2")
         h3task = nidaqmx.Task("Heater 3")
@@ -52,16 +111,15 @@ class temp_controller:
         return [h1task,h2task,h3task]
 
     def start_threads(self):
-        # Create Duty Cycle threads
+        # One thread runs the duty cycles of every heater
         self.stopthread = threading.Event()
 
-        h1dutycycle = threading.Thread(target=self.duty_cycle, args=(self.stopthread, self.queues[0], self.tasks[0], self.tps))
-        h2dutycycle = threading.Thread(target=self.duty_cycle, args=(self.stopthread, self.queues[1], self.tasks[1], self.tps))
-        h3dutycycle = threading.Thread(target=self.duty_cycle, args=(self.stopthread, self.queues[2], self.tasks[2], self.tps))
-        h1dutycycle.start()
-        h2dutycycle.start()
-        h3dutycycle.start()
-        return [h1dutycycle,h2dutycycle,h3dutycycle]
+        if self.pwm == "hardware":
+            heatercycle = threading.Thread(target=self.heater_buffer_cycle, args=(self.stopthread, self.queues, self.tasks[0], self.tps))
+        else:
+            heatercycle = threading.Thread(target=self.heater_cycle, args=(self.stopthread, self.queues, self.tasks, self.tps))
+        heatercycle.start()
+        return [heatercycle]
     
     def create_thermocouple_tasks(self):
         logging.info("main reactor,inlet lower, inlet upper, exhaust,TMA,Trap,Gauges")
@@ -77,34 +135,290 @@ class temp_controller:
         task.start()
         return task
     
+    def start_acquisition(self, rate=THERMOCOUPLE_RATE, block=THERMOCOUPLE_BLOCK, capacity=THERMOCOUPLE_CAPACITY):
+        # switches the thermocouples to continuous sample clocked acquisition into self.stream.buffer,
+        # read_thermocouples() then returns the newest sample instead of reading the DAQ
+        self.stream = acquisition_stream(self.thermocoupletask, rate, block, capacity)
+        self.stream.start()
+        return self.stream
+
     def read_thermocouples(self):
-        return self.thermocoupletask.read()
+        if self.stream is not None:
+            latest = self.stream.latest()
+            temps = latest[1].tolist() if latest is not None else [float("nan")]*len(self.tempchannels) # plain floats, as nidaqmx gives
+        else:
+            with self.read_lock:
+                temps = self.thermocoupletask.read()
+        self.history.append((time.monotonic(), temps, list(self.duties)))
+        return temps
 
-    #def log_temps
+    ###
+    # Closed loop control
+    # set_setpoint(heater, temperature) - hold heater's zone (self.heater_zones) at temperature (C), None for open loop
+    # start_pid(interval) - reads every thermocouple each interval, computes all heater loops in one step and
+    #                       queues the new duties. Duties typed in the GUI are overridden while a loop is on
+    # stop_pid() - stops the loop, heaters keep their last duty
+    ###
+    def set_setpoint(self, heater, temperature):
+        self.pid.set_setpoint(heater, temperature)
+        logging.info(f"Heater {heater+1} setpoint {temperature}")
 
-    def duty_cycle(self,stopthread, duty_queue, task, tps):
-        task.start()
-        voltageold = False # default voltage state
-        duty_queue.put(0) # default duty
+    def set_gains(self, heater, kp, ki, kd):
+        self.pid.kp[heater], self.pid.ki[heater], self.pid.kd[heater] = kp, ki, kd
+
+    def load_gains(self, file=autotune.GAINS_FILE):
+        # gains stored by autotune() for each heater's zone
+        stored = autotune.load_gains(file)
+        for heater, zone in enumerate(self.heater_zones):
+            gains = stored.get(SENSORS[zone])
+            if gains is not None:
+                self.set_gains(heater, gains["kp"], gains["ki"], gains["kd"])
+
+    def autotune(self, heater, setpoint, rule="tyreus-luyben", file=autotune.GAINS_FILE, **kwargs):
+        # relay autotune of one heater around setpoint (C), switching between full and zero duty
+        # the proposed gains are applied and stored under the heater's zone name
+        # other heaters keep running, the PID loop for this heater is switched off for the experiment
+        # kwargs - passed on to autotune.relay_autotune (hysteresis, interval, cycles, timeout, stop)
+        zone = self.heater_zones[heater]
+        self.set_setpoint(heater, None)
+        result = autotune.relay_autotune(lambda: self.read_thermocouples()[zone], self.queues[heater].put,
+                                         setpoint, high=self.tps, low=0, **kwargs)
+        kp, ki, kd = autotune.pid_gains(result["ku"], result["pu"], rule)
+        self.set_gains(heater, kp, ki, kd)
+        autotune.save_gains(SENSORS[zone], {"kp": kp, "ki": ki, "kd": kd, "ku": result["ku"], "pu": result["pu"]}, file)
+        logging.info(f"Heater {heater+1} ({SENSORS[zone]}) tuned: kp {kp:.4g}, ki {ki:.4g}, kd {kd:.4g}")
+        return kp, ki, kd
+
+    def start_pid(self, interval=PID_INTERVAL):
+        if self.pidthread is not None:
+            return
+        self.pid.reset()
+        self.stoppid = threading.Event()
+        self.pidthread = threading.Thread(target=self.pid_loop, args=(self.stoppid, interval))
+        self.pidthread.start()
+
+    def stop_pid(self):
+        if self.pidthread is None:
+            return
+        self.stoppid.set()
+        self.pidthread.join()
+        self.pidthread = None
+
+    def pid_loop(self, stoppid, interval):
+        duties = [None]*len(self.queues)
+        last = time.monotonic()
+        next_time = last
+        try:
+            while not stoppid.is_set():
+                temps = self.read_thermocouples()
+                now = time.monotonic()
+                output = self.pid.update([temps[z] for z in self.heater_zones], max(now - last, 1e-3))
+                last = now
+                for i, duty in enumerate(output):
+                    if np.isnan(self.pid.setpoints[i]):
+                        duties[i] = None # open loop, leave the duty to the operator
+                        continue
+                    duty = int(round(duty))
+                    if duty != duties[i]:
+                        duties[i] = duty
+                        self.queues[i].put(duty)
+                next_time += interval
+                stoppid.wait(next_time - time.monotonic())
+        except Exception as e:
+            # never leave a closed loop heater on its last duty with nothing watching it
+            for i in range(len(self.queues)):
+                if not np.isnan(self.pid.setpoints[i]):
+                    self.queues[i].put(0)
+            logging.error(f"PID loop stopped, closed loop heaters off: {e}")
+            print(f"PID loop stopped: {e}")
+            self.pidthread = None # start_pid can start it again
+
+    ###
+    # Preheat
+    # fit_zone_model(heater) - fits a first order model of heater's zone, the log needs a stretch where the
+    #                          heater changed duty (eg. a previous warm up). With a stream the temperatures are
+    #                          the stream's samples (DAQ timestamps, one row per sample) and the duty at each
+    #                          is the one in the newest self.history row at or before it, otherwise self.history
+    # preheat(setpoints, ready) - plans full power bursts so every zone reaches its setpoint at the same time,
+    #                             runs them, hands each zone to the PID loop on arrival and sets ready
+    #                             (eg. ald_controller.ready) once every zone has held within tolerance for settle s
+    # setpoints - one per heater, None leaves that heater alone
+    ###
+    def fit_zone_model(self, heater):
+        zone = self.heater_zones[heater]
+        snapshot = list(self.history) # read_thermocouples keeps appending from other threads
+        if self.stream is not None and snapshot:
+            times, samples = self.stream.buffer.since(float("-inf"))
+            logged = np.array([t for t, _, _ in snapshot])
+            order = np.argsort(logged, kind="stable") # reads from several threads can land out of order
+            logged = logged[order]
+            logged_duties = np.array([duties[heater] for _, _, duties in snapshot])[order]
+            i = np.searchsorted(logged, times, side="right") - 1 # duty in effect at each sample
+            keep = i >= 0
+            times, temps, duties = times[keep], samples[keep, zone], logged_duties[i[keep]]
+        else:
+            times, temps, duties = zip(*[(t, temps[zone], duties[heater]) for t, temps, duties in snapshot])
+        self.zone_models[heater] = thermal.fit_zone_model(times, temps, duties)
+        logging.info(f"Heater {heater+1} zone model: {self.zone_models[heater]}")
+        return self.zone_models[heater]
+
+    def preheat(self, setpoints, ready=None, tolerance=1.0, settle=60.0):
+        heaters = [i for i, sp in enumerate(setpoints) if sp is not None]
+        models = [self.zone_models.get(i) or self.fit_zone_model(i) for i in heaters]
+        temps = self.read_thermocouples()
+        arrival, plan = thermal.plan_preheat(models, [temps[self.heater_zones[i]] for i in heaters],
+                                             [setpoints[i] for i in heaters], self.tps)
+        logging.info(f"Preheat planned, all zones at setpoint in {arrival:.0f}s")
+        if ready is not None:
+            ready.clear()
+        self.stoppreheat = threading.Event()
+        self.preheatthread = threading.Thread(target=self.preheat_loop,
+            args=(self.stoppreheat, heaters, plan, [setpoints[i] for i in heaters], ready, tolerance, settle))
+        self.preheatthread.start()
+        return arrival, plan
+
+    def preheat_loop(self, stoppreheat, heaters, plan, setpoints, ready, tolerance, settle):
+        state = ["wait"]*len(heaters) # wait -> burst -> hold (PID)
+        for i in heaters:
+            self.set_setpoint(i, None)
+            self.queues[i].put(0)
+        start = time.monotonic()
+        settled = None # time every zone came within tolerance
+        while not stoppreheat.wait(PID_INTERVAL):
+            elapsed = time.monotonic() - start
+            temps = self.read_thermocouples()
+            for n, i in enumerate(heaters):
+                temp = temps[self.heater_zones[i]]
+                if state[n] == "wait" and elapsed >= plan[n].start:
+                    state[n] = "burst"
+                    self.queues[i].put(self.tps)
+                if state[n] == "burst" and (elapsed >= plan[n].start + plan[n].burst or temp >= setpoints[n] - tolerance):
+                    state[n] = "hold"
+                    self.start_pid()
+                    self.pid.preload(i, plan[n].hold)
+                    self.set_setpoint(i, setpoints[n])
+            within = all(s == "hold" and abs(temps[self.heater_zones[i]] - sp) <= tolerance
+                         for s, i, sp in zip(state, heaters, setpoints))
+            if not within:
+                settled = None
+            elif settled is None:
+                settled = time.monotonic()
+            elif time.monotonic() - settled >= settle:
+                logging.info(f"Preheat done in {time.monotonic() - start:.0f}s, ready")
+                if ready is not None:
+                    ready.set()
+                return
+
+    def heater_cycle(self, stopthread, duty_queues, tasks, tps):
+        # Duty cycles of all heaters from one thread
+        # each period is tps ticks of 1/tps s, a heater with duty d is on for d ticks from its offset
+        # instead of waking every tick, the thread sleeps straight to the next on/off edge of any heater,
+        # at most 2 wakeups per heater per period, and not at all while every heater is fully on or off.
+        # A queued duty wakes it through self.duty_event and takes effect straight away, within the current tick
+        # Periods follow each other on absolute deadlines
+        for task in tasks: task.start()
+        duties = [0]*len(tasks) # default duty
+        self.duties = duties
+        voltages = [False]*len(tasks) # default voltage state
+        period_start = time.monotonic()
         while not stopthread.is_set(): # loop until tc.stopthread.set()
-            if not duty_queue.empty(): # check for updates in queue
-                duty = duty_queue.get(block=False)
-
-            # Duty Cycle
-            for i in range(tps):
-                voltage = i < duty
-                if voltageold != voltage: # check if voltage should change from 1->0 or 0->1
-                    voltageold = voltage
-                    task.write(voltage) # send update signal to DAQ
-                    print(f"{task.name}: "+str(voltage))
-                time.sleep(1/tps)
+            now = time.monotonic()
+            if now - period_start >= 1.0: # keep the period phase across idle stretches
+                period_start += int(now - period_start)
+            tick = int((now - period_start)*tps + 1e-3) # tolerate waking a hair before the edge
+
+            offsets = self.offsets
+            voltage = [heater_phase.is_on(tick, duty, offset, tps) for duty, offset in zip(duties, offsets)]
+            changes = {i: v for i, v in enumerate(voltage) if voltages[i] != v} # 1->0 or 0->1
+            if changes:
+                self.write_heaters(tasks, changes) # send update signal to DAQ
+                for i, voltage in changes.items():
+                    voltages[i] = voltage
+                    print(f"{tasks[i].name}: "+str(voltage))
+
+            # next on/off edge of any heater, None if none of them is cycling
+            edges = [heater_phase.next_edge(tick, duty, offset, tps) for duty, offset in zip(duties, offsets)]
+            edges = [e for e in edges if e is not None]
+            timeout = period_start + (tick + min(edges))/tps - time.monotonic() if edges else None
+            if self.duty_event.wait(timeout):
+                self.duty_event.clear()
+                for i, duty_queue in enumerate(duty_queues): # latest duty wins
+                    while not duty_queue.empty():
+                        duties[i] = duty_queue.get(block=False)
+                self.update_offsets(duties)
         
+        # Close tasks after loop is told to stop by doing tc.stopthread.set() in main program
+        for task in tasks:
+            logging.info(f"Task {task.name}: Task Closing, Voltage set to False")
+            task.write(False)
+            task.stop()
+            print(f"Task {task.name}: Task Closing, Voltage set to False")
+            task.close()
+
+    def create_heater_buffer_task(self):
+        # one task for all heater lines, sample clocked at tps so one period is tps samples
+        if self.port is not None:
+            self.port.release(HEATER_LINES)
+        task = nidaqmx.Task("Heaters")
+        for channel in self.channels.values():
+            task.do_channels.add_do_chan(channel, line_grouping=LineGrouping.CHAN_PER_LINE)
+        task.timing.cfg_samp_clk_timing(self.tps, sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=self.tps)
+        task.out_stream.regen_mode = RegenerationMode.ALLOW_REGENERATION # the DAQ replays the period until rewritten
+        return task
+
+    def heater_buffer(self, duties, tps):
+        # one period of samples per heater, on for duty ticks from its offset
+        self.update_offsets(duties)
+        return heater_phase.buffer(duties, self.offsets, tps)
+
+    def update_offsets(self, duties):
+        if self.stagger:
+            self.offsets = heater_phase.stagger_phases(duties, self.tps)
+
+    def load_report(self, powers=HEATER_POWER):
+        # combined heater load over one period with the current duties and phases
+        profile = heater_phase.load_profile(self.duties, self.offsets, self.tps, powers)
+        return {"peak": float(profile.max()), "mean": float(profile.mean()), "profile": profile}
+
+    def heater_buffer_cycle(self, stopthread, duty_queues, task, tps):
+        # Hardware timed duty cycles, the thread sleeps until a duty is queued and rewrites the buffer
+        duties = [0]*len(duty_queues) # default duty
+        self.duties = duties
+        task.write(self.heater_buffer(duties, tps), auto_start=False)
+        task.start()
+        while not stopthread.is_set(): # loop until tc.stopthread.set()
+            self.duty_event.wait()
+            self.duty_event.clear()
+            changed = False
+            for i, duty_queue in enumerate(duty_queues): # latest duty wins
+                while not duty_queue.empty():
+                    duty = duty_queue.get(block=False)
+                    changed = changed or duty != duties[i]
+                    duties[i] = duty
+            if changed and not stopthread.is_set():
+                task.write(self.heater_buffer(duties, tps)) # takes over from the next full period
+                print(f"{task.name}: duties {duties}")
+
         # Close tasks after loop is told to stop by doing tc.stopthread.set() in main program
         logging.info(f"Task {task.name}: Task Closing, Voltage set to False")
-        task.write(False)
         task.stop()
-        print(f"Task {task.name}: Task Closing, Voltage set to False")
         task.close()
+        if self.port is not None:
+            self.port.reclaim(HEATER_LINES) # lines come back off
+        else:
+            with nidaqmx.Task() as off:
+                for channel in self.channels.values():
+                    off.do_channels.add_do_chan(channel, line_grouping=LineGrouping.CHAN_PER_LINE)
+                off.write([False]*len(self.channels))
+        print(f"Task {task.name}: Task Closing, Voltage set to False")
+
+    def write_heaters(self, tasks, changes):
+        # changes - {heater index: voltage}, heaters on a shared port switch in one write
+        if self.port is not None:
+            self.port.set_lines({tasks[i].name: voltage for i, voltage in changes.items()})
+        else:
+            for i, voltage in changes.items():
+                tasks[i].write(voltage)
 
     def update_duty_cycle(self, queue, duty):
         try:
@@ -119,7 +433,14 @@ class temp_controller:
             print(f"Invalid Input. Please enter an integer between 0 and {self.tps}.")   # turn into a log warning
   
     def close(self):
+        if self.preheatthread is not None:
+            self.stoppreheat.set()
+            self.preheatthread.join()
+        self.stop_pid()
+        if self.stream is not None:
+            self.stream.stop()
         self.stopthread.set()
+        self.duty_event.set() # wake the heater thread
         for t in self.threads[::]: t.join()
         self.thermocoupletask.close()
         print("Thermocouple Task closing")
\ No newline at end of file
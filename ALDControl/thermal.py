@@ -0,0 +1,135 @@
+import math
+from collections import deque, namedtuple
+
+import numpy as np
+
+# first order zone model, dT/dt = (ambient + gain*u - T)/tau
+# gain - C per unit of heater output, tau - s, ambient - C
+zone_model = namedtuple("zone_model", ["gain", "tau", "ambient"])
+
+# start - seconds from now to switch the heater to full output
+# burst - seconds of full output, reaching the setpoint at the common arrival time
+# hold - output that holds the setpoint once there
+preheat_step = namedtuple("preheat_step", ["start", "burst", "hold"])
+
+class thermal_plant:
+    ###
+    # thermal_plant(gain, tau, dead_time, ambient, clock) - simulated heater zone, first order plus dead time
+    # gain - steady state rise above ambient per unit of heater output (C per duty tick)
+    # tau - time constant (s)
+    # dead_time - delay between a heater change and the zone starting to respond (s)
+    # ambient - temperature with the heater off (C)
+    # clock - object with time(), eg. simulation.virtual_clock, the plant integrates up to clock.time() on every read
+    # stands in for one heater and its thermocouple when testing control code off-tool
+    ###
+    def __init__(self, gain, tau, dead_time=0.0, ambient=20.0, clock=None):
+        self.gain = gain
+        self.tau = tau
+        self.dead_time = dead_time
+        self.ambient = ambient
+        self.clock = clock
+        self.temperature = ambient
+        self.now = clock.time() if clock is not None else 0.0
+        self.inputs = deque([(-math.inf, 0.0)]) # (time, output) history, for the dead time
+
+    def set_duty(self, duty):
+        self.advance(self.clock.time())
+        self.inputs.append((self.now, duty))
+
+    def read(self):
+        self.advance(self.clock.time())
+        return self.temperature
+
+    def input_at(self, t):
+        # heater output in effect at time t, with old history dropped as it goes
+        while len(self.inputs) > 1 and self.inputs[1][0] <= t:
+            self.inputs.popleft()
+        return self.inputs[0][1]
+
+    def advance(self, to_time):
+        # exact first order response over each stretch of constant (delayed) input
+        while self.now < to_time:
+            t = self.now - self.dead_time
+            u = self.input_at(t)
+            step_end = to_time
+            if len(self.inputs) > 1: # stop at the next delayed input change
+                step_end = min(step_end, self.inputs[1][0] + self.dead_time)
+            dt = step_end - self.now
+            target = self.ambient + self.gain*u
+            self.temperature = target + (self.temperature - target)*math.exp(-dt/self.tau)
+            self.now = step_end
+
+
+class ModelError(ValueError):
+    pass
+
+
+def fit_zone_model(times, temps, outputs):
+    ###
+    # fit_zone_model(times, temps, outputs) - least squares fit of a zone_model to logged history
+    # times - sample times (s), temps - zone temperature (C), outputs - heater output in effect at each sample
+    # the history needs the heater to have changed output at least once, a flat log says nothing about tau
+    # rows that are not finite or repeat an earlier time (the same sample logged twice) are dropped
+    # raises ModelError if the fit is not a stable first order zone
+    ###
+    t = np.asarray(times, dtype=float)
+    T = np.asarray(temps, dtype=float)
+    u = np.asarray(outputs, dtype=float)
+    keep = np.isfinite(t) & np.isfinite(T) & np.isfinite(u)
+    t, T, u = t[keep], T[keep], u[keep]
+    order = np.argsort(t, kind="stable")
+    first = np.concatenate([[True], np.diff(t[order]) > 0]) if len(t) else np.zeros(0, dtype=bool)
+    t, T, u = t[order][first], T[order][first], u[order][first]
+    if len(t) < 3:
+        raise ModelError("not enough history to fit a zone model")
+    dTdt = np.diff(T)/np.diff(t)
+    # dT/dt = alpha*u + beta*T + c
+    A = np.column_stack([u[:-1], T[:-1], np.ones(len(dTdt))])
+    (alpha, beta, c), *_ = np.linalg.lstsq(A, dTdt, rcond=None)
+    if not beta < 0 or not alpha > 0:
+        raise ModelError(f"history does not fit a stable heated zone (alpha {alpha:.3g}, beta {beta:.3g})")
+    return zone_model(gain=float(-alpha/beta), tau=float(-1/beta), ambient=float(-c/beta))
+
+
+def time_to_reach(model, start, target, output):
+    # seconds for the zone to go from start to target (C) at constant output, inf if it never gets there
+    if start >= target:
+        return 0.0
+    final = model.ambient + model.gain*output
+    if final <= target:
+        return math.inf
+    return model.tau*math.log((final - start)/(final - target))
+
+
+def cooled(model, start, seconds):
+    # temperature after seconds with the heater off
+    return model.ambient + (start - model.ambient)*math.exp(-seconds/model.tau)
+
+
+def plan_preheat(models, temps, setpoints, full):
+    ###
+    # plan_preheat(models, temps, setpoints, full) - full power burst plan that lands every zone on its setpoint together
+    # models, temps, setpoints - one zone_model, current temperature and setpoint (C) per zone
+    # full - heater output at full power
+    # the slowest zone starts straight away, the others wait with the heater off (allowing for the cooling
+    # while they wait) and then burst so they arrive at the same moment
+    # returns (arrival time (s), [preheat_step per zone])
+    # raises ModelError if a zone cannot reach its setpoint at full power
+    ###
+    bursts = [time_to_reach(m, T, sp, full) for m, T, sp in zip(models, temps, setpoints)]
+    for i, b in enumerate(bursts):
+        if math.isinf(b):
+            raise ModelError(f"zone {i} cannot reach {setpoints[i]}C at full power")
+    arrival = max(bursts)
+    plan = []
+    for m, T, sp in zip(models, temps, setpoints):
+        lo, hi = 0.0, arrival # bisect on the wait so wait + burst from the cooled temperature == arrival
+        for _ in range(60):
+            wait = (lo + hi)/2
+            if wait + time_to_reach(m, cooled(m, T, wait), sp, full) > arrival:
+                hi = wait
+            else:
+                lo = wait
+        hold = min(max((sp - m.ambient)/m.gain, 0.0), full)
+        plan.append(preheat_step(start=lo, burst=arrival - lo, hold=hold))
+    return arrival, plan
@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+
+class timing_log:
+    ###
+    # timing_log(capacity, clock) - planned vs actual time of every valve actuation in a run
+    # capacity - number of actuations to make room for, the arrays are allocated once up front
+    # clock - time source matching the run's scheduler (s)
+    # times are seconds from start(), actuations past capacity are counted in self.dropped
+    ###
+    def __init__(self, capacity, clock=time.monotonic):
+        self.clock = clock
+        self.planned = np.zeros(capacity)
+        self.actual = np.zeros(capacity)
+        self.valve = np.zeros(capacity, dtype=np.int8)
+        self.state = np.zeros(capacity, dtype=bool)
+        self.loop = np.zeros(capacity, dtype=np.int32)
+        self.row = np.zeros(capacity, dtype=np.int32)
+        self.count = 0
+        self.dropped = 0
+        self.start_time = 0.0
+
+    def start(self, start_time):
+        # start_time - clock time the run's timeline is measured from
+        self.start_time = start_time
+
+    def mark(self, planned, states):
+        # called by the valve controller straight after the write for a set of valves
+        # planned - (seconds from start, loop, row) the write was scheduled for
+        # states - {valve index: bool} that were written
+        actual = self.clock() - self.start_time
+        offset, loop, row = planned
+        for k, state in states.items():
+            i = self.count
+            if i >= len(self.planned):
+                self.dropped += 1
+                continue
+            self.planned[i] = offset
+            self.actual[i] = actual
+            self.valve[i] = k
+            self.state[i] = state
+            self.loop[i] = loop
+            self.row[i] = row
+            self.count += 1
+
+    def lateness(self):
+        return self.actual[:self.count] - self.planned[:self.count]
+
+    def pulse_width_error(self):
+        # actual minus planned open time for every open/close pair, any valve
+        opened = {}
+        errors = []
+        for i in range(self.count):
+            k = self.valve[i]
+            if self.state[i]:
+                opened[k] = i
+            elif k in opened:
+                j = opened.pop(k)
+                errors.append((self.actual[i] - self.actual[j]) - (self.planned[i] - self.planned[j]))
+        return np.array(errors)
+
+    def cycle_drift(self):
+        # lateness of the first actuation of each loop, a steady climb means the run is drifting
+        n = self.count
+        if not n:
+            return np.zeros(0)
+        _, first = np.unique(self.loop[:n], return_index=True)
+        return self.actual[first] - self.planned[first]
+
+    def summary(self):
+        # lateness percentiles, pulse width error and cycle drift, all in seconds
+        late = self.lateness()
+        width = self.pulse_width_error()
+        drift = self.cycle_drift()
+        summary = {"actuations": self.count, "dropped": self.dropped}
+        if len(late):
+            for p in (50, 90, 99):
+                summary[f"late_p{p}"] = float(np.percentile(late, p))
+            summary["late_max"] = float(late.max())
+        if len(width):
+            summary["width_error_mean"] = float(width.mean())
+            summary["width_error_max"] = float(np.abs(width).max())
+        if len(drift) > 1:
+            summary["cycle_drift"] = float(drift[-1] - drift[0])
+        return summary
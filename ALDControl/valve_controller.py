@@ -1,19 +1,34 @@
 import nidaqmx
-from nidaqmx.constants import LineGrouping
+from nidaqmx.constants import AcquisitionType, LineGrouping, RegenerationMode, TaskMode
+import logging
 import time
 import threading
 
+import numpy as np
+
+STREAM_BUFFER = 2.0 # s of waveform held in the DAQ buffer ahead of the sample clock
+
 # creating a valve_controller object will setup all relevant channels
 # access said object in order to run methods on the valves connected to channels defined below
 
 # currently hard coded for the three valves of this ALD system
+# port - optional do_port shared with the other CDAQ1Mod4 lines, valve writes then go through its single task
+# persistent - start and commit the valve tasks once here and keep them running, so an actuation is a single
+#              write instead of start()/write()/stop(). False restores the old per-actuation start/stop
 class valve_controller:
-    def __init__(self):
+    def __init__(self, port=None, persistent=True):
         self.valvechannels = { "AV01": "cDAQ1Mod4/line0", # TMA
                                "AV02": "CDAQ1Mod4/line1", # D20
                                "AV03": "CDAQ1Mod4/line2", # H20
                              }
-        self.tasks = self.create_valve_tasks()
+        self.port = port
+        self.persistent = persistent
+        self.timing = None # timing_log set by ald_controller for the length of a run
+        self.listeners = [] # called with (valve index, state, time.monotonic()) on every valve change
+        if port is None:
+            self.tasks = self.create_valve_tasks()
+        else:
+            self.tasks = [port.line(name) for name in self.valvechannels]
         # log valve controller initialized
         
     def create_valve_tasks(self):
@@ -23,36 +38,202 @@ class valve_controller:
         AV01.do_channels.add_do_chan(self.valvechannels["AV01"], line_grouping=LineGrouping.CHAN_PER_LINE)
         AV02.do_channels.add_do_chan(self.valvechannels["AV02"], line_grouping=LineGrouping.CHAN_PER_LINE)
         AV03.do_channels.add_do_chan(self.valvechannels["AV03"], line_grouping=LineGrouping.CHAN_PER_LINE)
-        return [AV01, AV02, AV03]
+        tasks = [AV01, AV02, AV03]
+        if self.persistent:
+            self.start_tasks(tasks)
+        return tasks
+
+    def start_tasks(self, tasks):
+        for task in tasks:
+            task.control(TaskMode.TASK_COMMIT) # reserve and program the lines once
+            task.start()
+
+    def stop_tasks(self, tasks):
+        for task in tasks:
+            task.stop()
+            task.control(TaskMode.TASK_UNRESERVE) # free the lines for other tasks
+
+    def write(self,task,state):
+        if self.persistent:
+            task.write(state)
+        else:
+            task.start()
+            task.write(state)
+            task.stop()
+        self.notify({self.tasks.index(task): state})
 
+    def notify(self,states,t=None):
+        # states - {valve index: bool}, t - when they switched, now if None
+        if self.listeners:
+            t = time.monotonic() if t is None else t
+            for listener in self.listeners:
+                for k, state in states.items():
+                    listener(k, state, t)
         
     def open_valve(self,task):
-        task.start()
-        task.write(True)
-        time.sleep(0.1)
+        self.write(task, True)
+        if not self.persistent:
+            time.sleep(0.1)
         #log valve opened
-        task.stop()
         
     def close_valve(self,task):
-        task.start()
-        task.write(False)
-        time.sleep(0.1)
+        self.write(task, False)
+        if not self.persistent:
+            time.sleep(0.1)
         #log valve closed
-        task.stop()
+
+    def set_valve(self,task,state):
+        # open (True) or close (False) a valve without waiting, for callers that do their own timing
+        self.write(task, state)
 
     def pulse_valve(self,task,pulse_length):
-        task.start()
+        if not self.persistent:
+            task.start()
         task.write(True)
+        self.notify({self.tasks.index(task): True})
         time.sleep(pulse_length)
         task.write(False)
+        self.notify({self.tasks.index(task): False})
         #log valve pulsed
-        task.stop()
+        if not self.persistent:
+            task.stop()
 
-    def close_all(self):
-        for task in self.tasks[::]:
+    def latency_report(self, n=100):
+        # times n actuations of the first valve with and without the start()/stop() transitions
+        # only False is written, so the valve stays shut. returns the median seconds per actuation
+        # on a shared do_port there is no start()/stop() to time and writing an unchanged line skips the DAQ,
+        # so only the port's own write is timed, start_write_stop is None
+        task = self.tasks[0]
+        def median(actuate):
+            times = []
+            for i in range(n):
+                t = time.perf_counter()
+                actuate()
+                times.append(time.perf_counter() - t)
+            return sorted(times)[n//2]
+        def start_write_stop():
             task.start()
             task.write(False)
             task.stop()
+
+        if self.port is not None:
+            committed = median(self.port.rewrite)
+            logging.info(f"Valve actuation latency: shared port write {committed*1000:.3f}ms")
+            return {"start_write_stop": None, "write": committed}
+
+        if self.persistent:
+            self.stop_tasks([task])
+        transition = median(start_write_stop)
+        self.start_tasks([task])
+        committed = median(lambda: task.write(False))
+        if not self.persistent:
+            self.stop_tasks([task])
+
+        logging.info(f"Valve actuation latency: start/write/stop {transition*1000:.3f}ms, committed write {committed*1000:.3f}ms")
+        return {"start_write_stop": transition, "write": committed}
+
+    def play_waveform(self, data, rate, stop=None):
+        # plays a sample clocked waveform on all valve lines, blocks until the DAQ is done
+        # data - one list of bools per valve, in self.tasks order (see recipe.render_waveform)
+        # rate - sample clock rate (Hz)
+        # stop - optional threading.Event, setting it cuts the waveform short and closes the valves
+        # returns True if the whole waveform played
+        return self.play_waveform_blocks([data], rate, stop) == 1
+
+    def play_waveform_blocks(self, blocks, rate, stop=None, progress=None):
+        # plays waveforms back to back on one sample clocked task, with no gap between them
+        # blocks - sequence of waveforms like play_waveform's data, streamed into the task as it plays,
+        #          so a whole run (eg. the same cycle block repeated) needs only a couple of blocks in memory
+        # progress - optional progress(n), called on this thread each time the DAQ finishes another block
+        # returns the number of blocks that played to the end, len(blocks) if stop was never set
+        # the lines leave the port (or the persistent tasks stop) once for the whole sequence
+        if self.port is not None:
+            with self.port.detach(self.valvechannels):
+                return self.play_waveform_task(blocks, rate, stop, progress)
+        if self.persistent:
+            self.close_all()
+            self.stop_tasks(self.tasks)
+        try:
+            return self.play_waveform_task(blocks, rate, stop, progress)
+        finally:
+            if self.persistent:
+                self.start_tasks(self.tasks)
+
+    def play_waveform_task(self, blocks, rate, stop=None, progress=None):
+        ends = np.cumsum([len(data[0]) for data in blocks]) # sample count at the end of each block
+        samples = int(ends[-1])
+        buffer = min(samples, max(2*int(np.max(np.diff(ends, prepend=0))), int(rate*STREAM_BUFFER)))
+        with nidaqmx.Task("AV waveform") as task:
+            for channel in self.valvechannels.values():
+                task.do_channels.add_do_chan(channel, line_grouping=LineGrouping.CHAN_PER_LINE)
+            task.timing.cfg_samp_clk_timing(rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=samples)
+            task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION # every sample is written once
+            task.out_stream.output_buf_size = buffer
+
+            written = 0 # blocks written to the task
+            while written < len(blocks) and ends[written] <= buffer: # fill the buffer before the clock starts
+                task.write(blocks[written], auto_start=False)
+                written += 1
+            task.start()
+            t0 = time.monotonic()
+            for i in range(written):
+                self.notify_openings(blocks, i, rate, t0, ends)
+
+            played = 0 # blocks the DAQ has finished
+            while played < len(blocks):
+                generated = task.out_stream.total_samp_per_chan_generated
+                now_played = int(np.searchsorted(ends, generated, side="right"))
+                if now_played > played:
+                    played = now_played
+                    if progress is not None:
+                        progress(played)
+                    continue
+                if written < len(blocks) and task.out_stream.space_avail >= len(blocks[written][0]):
+                    task.write(blocks[written], auto_start=False)
+                    self.notify_openings(blocks, written, rate, t0, ends)
+                    written += 1
+                    continue
+                if task.is_task_done():
+                    played = len(blocks)
+                    if progress is not None:
+                        progress(played)
+                    break
+                if stop is not None and stop.wait(0.05): # check in every 50ms
+                    break
+                if stop is None:
+                    time.sleep(0.05)
+            task.stop()
+        #log waveform played
+        return played
+
+    def notify_openings(self, blocks, n, rate, t0, ends):
+        # tells listeners when each valve in blocks[n] will open, t0 - time.monotonic() of the first sample
+        # a valve still open from the end of the block before is not a new opening
+        if self.listeners:
+            before = np.asarray(blocks[n - 1], dtype=np.int8)[:, -1:] if n else np.zeros((len(blocks[n]), 1), dtype=np.int8)
+            rising = np.diff(np.asarray(blocks[n], dtype=np.int8), axis=1, prepend=before) > 0
+            start = t0 + (ends[n - 1] if n else 0)/rate
+            for k, i in zip(*np.nonzero(rising)):
+                self.notify({int(k): True}, start + i/rate)
+
+    def set_valves(self,states,planned=None):
+        # states - {valve index: bool}, valves on a shared port all switch in the same write
+        # planned - (seconds from run start, loop, row) the write was scheduled for, marked in self.timing
+        if self.port is not None:
+            self.port.set_lines({self.tasks[k].name: state for k, state in states.items()})
+            self.notify(states)
+        else:
+            for k, state in states.items():
+                self.set_valve(self.tasks[k], state)
+        if planned is not None and self.timing is not None:
+            self.timing.mark(planned, states)
+
+    def close_all(self):
+        if self.port is not None:
+            self.set_valves({k: False for k in range(len(self.tasks))})
+            return
+        for task in self.tasks[::]:
+            self.write(task, False)
         #log valves closed
 
     def close(self):